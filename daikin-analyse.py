@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+
+"""Pull the samples out of the log files written by daikin-monitor.py
+and daikin-zappi.py, and summarise them.
+
+Usage: daikin-analyse.py [-o out.npz] [--hlc W/K] [logfile ...]
+
+The default is all of /tmp/daikin.*.log.gz. The files are parsed in
+parallel, one per process, each streamed through gzip rather than being
+decompressed in one go. The log of a script that's still running (or
+was killed) hasn't got the end of the gzip stream written, so reading it
+stops with an error partway through the last block - that's ignored, and
+everything before it is used.
+
+Prints
+ - the mean power at each outdoor temperature (zappi logs only)
+ - an estimate of the COP at each outdoor temperature - this is very
+   rough: the heat delivered is taken to be the heat lost by the house,
+   which is --hlc (the heat loss coefficient, W/K) times the difference
+   between room and outdoor temperatures
+ - the hot water cycles: when the tank temperature rose, and how long it took
+
+With -o, the samples are also written as a numpy .npz, with one array per
+column (the same columns as daikin_store.py), so
+    np.load("out.npz")["outdoor"]
+"""
+
+import concurrent.futures
+import glob
+import gzip
+import re
+import sys
+import time
+import zlib
+
+import numpy as np
+
+from daikin_store import FIELDS, NUMPY_DTYPE
+
+# eg "2024-10-25--00:05: power= 840 outdoor=13 room=20.3 / 20.5 hw=38  lwt=20 (offs=0)"
+LINE = re.compile(r"(\d{4})-(\d\d)-(\d\d)--(\d\d)[:-](\d\d): (?=power=|outdoor=)")
+VALUE = re.compile(r"(\w+)=\s*(-?[\d.]+)")
+ROOM = re.compile(r"room=\s*(-?[\d.]+) / \s*(-?[\d.]+)")
+
+# what the log calls things, if it's not what the store does
+NAMES = {"offs": "offset"}
+
+
+def parse_line(line: str):
+    """Turn a sample line from a log into a tuple for NUMPY_DTYPE,
+    or None if it isn't one"""
+    m = LINE.match(line)
+    if not m:
+        return None
+    y, mon, d, h, mins = (int(x) for x in m.groups())
+    t = time.mktime((y, mon, d, h, mins, 0, 0, 0, -1))
+    values = {NAMES.get(k, k): float(v) for k, v in VALUE.findall(line, m.end())}
+    room = ROOM.search(line)
+    if room:
+        values["room"], values["target"] = float(room[1]), float(room[2])
+    return (t,) + tuple(values.get(f, np.nan) for f in FIELDS)
+
+
+def parse_file(name: str) -> np.ndarray:
+    """Read all the samples from a log file (run in a worker process)"""
+    rows = []
+    try:
+        with gzip.open(name, "rt", errors="replace") as f:
+            for line in f:
+                if not line.endswith("\n"):
+                    break  # only part of the last line made it
+                row = parse_line(line)
+                if row:
+                    rows.append(row)
+    except (EOFError, zlib.error, gzip.BadGzipFile):
+        pass  # truncated - keep what we've got
+    return np.array(rows, dtype=NUMPY_DTYPE)
+
+
+def load(files, workers=None) -> np.ndarray:
+    """Parse the files in parallel, and return all the samples in time order"""
+    with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+        parts = list(pool.map(parse_file, files))
+    if not parts:
+        return np.zeros(0, dtype=NUMPY_DTYPE)
+    samples = np.concatenate(parts)
+    return samples[np.argsort(samples["time"], kind="stable")]
+
+
+def by_outdoor(samples: np.ndarray, hlc: float):
+    """Per whole degree of outdoor temperature: (temperature, samples,
+    mean power, estimated COP)"""
+    s = samples[~np.isnan(samples["power"]) & ~np.isnan(samples["outdoor"])]
+    bins = np.round(s["outdoor"]).astype(int)
+    temps, inverse, counts = np.unique(bins, return_inverse=True, return_counts=True)
+    power = np.bincount(inverse, weights=s["power"]) / counts
+    # heat lost by the house, which the heatpump has to make up
+    loss = hlc * np.clip(s["room"] - s["outdoor"], 0, None)
+    ok = ~np.isnan(loss)
+    heat = np.bincount(inverse[ok], weights=loss[ok], minlength=len(temps))
+    used = np.bincount(inverse[ok], weights=s["power"][ok], minlength=len(temps))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        cop = np.where(used > 0, heat / used, np.nan)
+    return temps, counts, power, cop
+
+
+def hot_water_cycles(samples: np.ndarray, min_rise: float = 5, max_gap: float = 3600):
+    """Find the runs where the tank temperature kept rising, by at least
+    min_rise degrees. Returns a list of (start time, duration, from, to)."""
+    s = samples[~np.isnan(samples["hw"])]
+    t, hw = s["time"].astype(float), s["hw"].astype(float)
+    cycles = []
+    start = 0
+    for i in range(1, len(s) + 1):
+        if i < len(s) and t[i] - t[i - 1] <= max_gap:
+            if hw[i] > hw[i - 1] or hw[start] < hw[i - 1] == hw[i]:
+                continue  # still rising (perhaps pausing for a sample)
+            if hw[i] == hw[i - 1]:
+                start = i  # flat - hasn't started rising yet
+                continue
+        # the run has ended - at the last sample that was a rise
+        end = i - 1
+        while end > start and hw[end] == hw[end - 1]:
+            end -= 1
+        if hw[end] - hw[start] >= min_rise:
+            cycles.append((t[start], t[end] - t[start], hw[start], hw[end]))
+        start = i
+    return cycles
+
+
+def main():
+    args = sys.argv[1:]
+    out = None
+    hlc = 200.0
+    while args and args[0].startswith("-"):
+        opt = args.pop(0)
+        if opt == "-o" and args:
+            out = args.pop(0)
+        elif opt == "--hlc" and args:
+            hlc = float(args.pop(0))
+        else:
+            print(f"Usage: {sys.argv[0]} [-o out.npz] [--hlc W/K] [logfile ...]")
+            return
+    files = args or sorted(glob.glob("/tmp/daikin.*.log.gz"))
+
+    start = time.perf_counter()
+    samples = load(files)
+    elapsed = time.perf_counter() - start
+    print(f"{len(samples)} samples from {len(files)} files in {elapsed:.2f}s")
+    if not len(samples):
+        return
+
+    print(f"\noutdoor  samples  power(W)  est. COP (hlc={hlc:g} W/K)")
+    for temp, count, power, cop in zip(*by_outdoor(samples, hlc)):
+        print(f"  {temp:4d}  {count:7d}  {power:8.0f}  {cop:8.2f}")
+
+    cycles = hot_water_cycles(samples)
+    print(f"\n{len(cycles)} hot water cycles")
+    for t, duration, t0, t1 in cycles:
+        when = time.strftime("%Y-%m-%d %H:%M", time.localtime(t))
+        print(f"  {when}  {duration / 60:4.0f} min  {t0:.0f} -> {t1:.0f}")
+
+    if out:
+        np.savez(out, **{name: samples[name] for name in samples.dtype.names})
+        print(f"\nsamples written to {out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+
+"""Benchmarks for the Daikin class, run against the local mock server.
+
+Usage: daikin-bench.py [latency-ms] [processes]
+
+Reports
+ - how many api and token requests each high-level operation costs
+ - how long management_points() takes (with the given simulated latency)
+ - what happens when several processes find the key has expired at
+   the same moment: how many refreshes actually happen, whether any
+   fail, and how long the processes spent waiting for the lock.
+
+Everything uses a temporary directory for the config, key, quota and
+cache files, so it doesn't touch the real ones.
+"""
+
+import fcntl
+import json
+import multiprocessing
+import pathlib
+import statistics
+import sys
+import tempfile
+import time
+
+import daikin as daikin_module
+
+from daikin import Daikin
+from daikin_fields import SENSORS
+from daikin_mock import MockOnecta
+
+
+def client_class(mock: MockOnecta, tmp: pathlib.Path):
+    """A Daikin subclass that uses the mock server and the temporary files"""
+    return type(
+        "BenchDaikin",
+        (Daikin,),
+        {
+            "app_file": tmp / "app.json",
+            "key_file": tmp / "key.json",
+            "quota_file": tmp / "quota.json",
+            "cache_file": tmp / "cache.json",
+            # not the real broker, which would hand out real keys
+            "broker_socket": tmp / "broker.sock",
+            "idp_url": mock.idp_url,
+            "api_url": mock.api_url,
+        },
+    )
+
+
+def write_key(mock: MockOnecta, tmp: pathlib.Path, expires_in=None) -> None:
+    """Issue a new key and store it, optionally with a different lifetime
+    (0 means the clients will all think it needs refreshing)
+    """
+    key = mock.new_key()
+    if expires_in is not None:
+        key["expires_in"] = expires_in
+    with (tmp / "key.json").open("w") as kf:
+        json.dump(key, kf)
+
+
+def summary(times: list) -> str:
+    times = sorted(times)
+    p95 = times[int(0.95 * (len(times) - 1))]
+    return (
+        f"min {1000 * times[0]:.1f}ms  median {1000 * statistics.median(times):.1f}ms"
+        f"  p95 {1000 * p95:.1f}ms  max {1000 * times[-1]:.1f}ms"
+    )
+
+
+def bench_requests(mock, tmp, cls) -> None:
+    print("requests per operation (api / token):")
+
+    def cached_twice(d):
+        d.management_points()
+        d.management_points()
+
+    ops = [
+        ("management_points()", lambda d: d.management_points()),
+        ("read_fields(SENSORS)", lambda d: d.read_fields(SENSORS)),
+        ("management_points() x2, cached", cached_twice),
+        (
+            "set_temperature_control()",
+            lambda d: d.set_temperature_control("leavingWaterOffset", 1),
+        ),
+        ("set_powerful_mode()", lambda d: d.set_powerful_mode(True)),
+    ]
+    for expired in (False, True):
+        for name, op in ops:
+            write_key(mock, tmp, 0 if expired else None)
+            (tmp / "cache.json").unlink(missing_ok=True)
+            d = cls(cache_ttl=60)
+            if "cached" not in name:
+                d.cache = None
+            d.device = mock.gateways[0]["id"]
+            mock.reset_counts()
+            op(d)
+            api = mock.api_requests()
+            token = mock.counts.get("refresh", 0)
+            label = name + (" (expired key)" if expired else "")
+            print(f"  {label:45s} {api:3d} / {token}")
+
+
+def bench_latency(mock, tmp, cls, iterations=50) -> None:
+    write_key(mock, tmp)
+    d = cls()
+    d.management_points()  # warm up the connection
+    times = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        d.management_points()
+        times.append(time.perf_counter() - start)
+    print(
+        f"management_points() latency ({iterations} calls, {1000 * mock.latency:.0f}ms simulated):"
+    )
+    print("  " + summary(times))
+
+
+def _contender(cls, barrier, results) -> None:
+    """Run in a child process: wait for the others, then check the key"""
+    waited = []
+    flock = fcntl.flock
+
+    def timed_flock(fd, op):
+        start = time.perf_counter()
+        flock(fd, op)
+        if op & fcntl.LOCK_EX:
+            waited.append(time.perf_counter() - start)
+
+    daikin_module.fcntl.flock = timed_flock
+
+    d = cls()
+    barrier.wait()
+    start = time.perf_counter()
+    try:
+        d.check_key_expiry()
+        ok = True
+    except Exception:
+        ok = False
+    results.put((time.perf_counter() - start, sum(waited), ok))
+
+
+def bench_contention(mock, tmp, cls, processes: int) -> None:
+    write_key(mock, tmp, expires_in=0)
+    mock.reset_counts()
+
+    ctx = multiprocessing.get_context("fork")
+    barrier = ctx.Barrier(processes)
+    results = ctx.Queue()
+    procs = [
+        ctx.Process(target=_contender, args=(cls, barrier, results))
+        for _ in range(processes)
+    ]
+    for p in procs:
+        p.start()
+    got = [results.get() for _ in procs]
+    for p in procs:
+        p.join()
+
+    elapsed = [g[0] for g in got]
+    waits = [g[1] for g in got]
+    failed = sum(1 for g in got if not g[2])
+    print(f"{processes} processes refreshing an expired key at once:")
+    print(
+        f"  refreshes: {mock.counts.get('refresh', 0)}"
+        f"  rejected: {mock.counts.get('bad refresh', 0)}  client failures: {failed}"
+    )
+    print("  time in check_key_expiry: " + summary(elapsed))
+    print("  time waiting for lock:    " + summary(waits))
+
+
+def main():
+    latency = float(sys.argv[1]) / 1000 if len(sys.argv) > 1 else 0.05
+    processes = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+
+    mock = MockOnecta()
+    mock.daily_limit = 10**6  # don't want to hit that here
+    mock.start()
+
+    with tempfile.TemporaryDirectory() as d:
+        tmp = pathlib.Path(d)
+        with (tmp / "app.json").open("w") as af:
+            json.dump({"id": "bench", "secret": "bench"}, af)
+        cls = client_class(mock, tmp)
+
+        bench_requests(mock, tmp, cls)
+        mock.latency = latency
+        bench_latency(mock, tmp, cls)
+        bench_contention(mock, tmp, cls, processes)
+
+    mock.stop()
+
+
+if __name__ == "__main__":
+    main()
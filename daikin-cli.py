@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+
+"""A quick way to run daikin.py commands from shell scripts.
+
+Usage: daikin-cli.py <daikin.py command...>
+       daikin-cli.py consumption [d|w|m] [f]
+
+If the broker (daikin_broker.py) is running, the command is passed to it
+to run, using its Daikin, which already has the key, an open connection
+to the api, and maybe a recent gateway-devices in the cache. This script
+only imports the standard modules it needs to talk to the broker, so the
+whole thing takes a few tens of milliseconds rather than most of a second.
+
+If there's no broker, it just runs the command itself, exactly as
+daikin.py (or daikin-consumption.py) would. But if the broker took the
+command and then didn't answer, that's an error - the command may have
+been done (eg a change sent), so it isn't run again.
+"""
+
+import importlib
+import pathlib
+import sys
+
+import daikin_broker
+
+# the same as Daikin.broker_socket - but importing daikin to find
+# that out would mean importing requests, which is what we're avoiding
+SOCKET = pathlib.Path("/tmp/daikin_broker.sock")
+
+# these need doing here, rather than by the broker
+LOCAL = ("code", "help")
+
+
+def main():
+    argv = sys.argv[1:]
+    script = "daikin"
+    if argv and argv[0] == "consumption":
+        script, argv = "consumption", argv[1:]
+
+    if argv and argv[0] not in LOCAL:
+        request = {"op": "cli", "script": script, "argv": argv}
+        # allow for the command having to wait for quota, and retries
+        s = daikin_broker.connect(SOCKET, timeout=300)
+        if s is not None:
+            try:
+                reply = daikin_broker.send(s, request)
+            except daikin_broker.BrokerError as e:
+                # don't run it again here - it may have been done already
+                print(
+                    f"error: {e} - the command may or may not have run", file=sys.stderr
+                )
+                sys.exit(1)
+            sys.stdout.write(reply.get("output", ""))
+            if "error" in reply:
+                print("error:", reply["error"], file=sys.stderr)
+                sys.exit(1)
+            return
+
+    # no broker - do it ourselves
+    sys.argv = [sys.argv[0]] + argv
+    if script == "consumption":
+        importlib.import_module("daikin-consumption").main()
+    else:
+        importlib.import_module("daikin").main()
+
+
+if __name__ == "__main__":
+    main()
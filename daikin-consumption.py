@@ -13,45 +13,58 @@ get last year.
 
 I anticipate that you might run this say 4am every day to get yesterday's
 results, or on monday morning to get last week's results, once they're complete.
+
+The figures are also merged into an archive (see daikin_history.py), and
+if that already has the period wanted, it's printed from there without
+using the api at all. Add 'f' to force a fetch anyway.
 """
 
 import datetime
 import sys
 
+from typing import Optional, TextIO
+
 from daikin import Daikin
+from daikin_history import History, previous_period
 
 
-def main():
-    if len(sys.argv) == 1 or sys.argv[1] not in ("d", "w", "m"):
-        print(f"Usage: {sys.argv[0]} [d|w|m]")
+def run(daikin: Optional[Daikin], argv: list, out: Optional[TextIO] = None) -> None:
+    """Do the work, for argv without the script name. daikin can be passed
+    in (eg by the broker, for daikin-cli.py), otherwise one is made if a fetch
+    is needed."""
+    out = out or sys.stdout
+    if not argv or argv[0] not in ("d", "w", "m"):
+        print(f"Usage: {sys.argv[0]} [d|w|m] [f]", file=out)
         return
-    want = sys.argv[1]
+    want = argv[0]
+    force = len(argv) > 1 and argv[1] == "f"
 
-    daikin = Daikin()
+    history = History()
 
-    mp = daikin.management_points()
+    if force or history.due(want):
+        # no need to fetch again if a monitor has just done so
+        daikin = daikin or Daikin(cache_ttl=540)
+        index = daikin.devices()
+        for device in index:
+            history.merge(device, index.management_points(device))
 
     today = datetime.datetime.now().date()
-    if want == "d":
-        delta = datetime.timedelta(days=1)  # wind back one day to yesterday
-        start = today - delta
-        count = 12
-    elif want == "w":
-        # wind back 7 days plus whichever day number this is (mon=0, tue=1, ...)
-        # The results start on a Monday
-        delta = datetime.timedelta(days=today.weekday() + 7)
-        start = today - delta
-        count = 7
-    else:
-        # start date is 1st Jan in the previous year
-        start = datetime.date(year=today.year - 1, month=1, day=1)
-        count = 12
-
-    for device in ("climateControlMainZone", "domesticHotWaterTank"):
-        consumption = mp[device]["consumptionData"]["value"]["electrical"]["heating"][
-            want
-        ]
-        print(f"{start} {device:22s} ", *(f"{x:3d}" for x in consumption[0:count]))
+    keys = previous_period(want, today)
+    start = keys[0][:10] if want != "m" else keys[0] + "-01"
+
+    for device in history.load():
+        for emb in ("climateControlMainZone", "domesticHotWaterTank"):
+            series = history.series(device, emb, want)
+            consumption = [series.get(k) for k in keys]
+            print(
+                f"{start} {emb:22s} ",
+                *("  -" if x is None else f"{x:3d}" for x in consumption),
+                file=out,
+            )
+
+
+def main():
+    run(None, sys.argv[1:])
 
 
 if __name__ == "__main__":
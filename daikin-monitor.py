@@ -8,6 +8,12 @@ import logging
 import gzip
 
 from daikin import Daikin
+from daikin_archive import Archive
+from daikin_fields import SENSORS
+from daikin_metrics import export_from_env
+from daikin_patches import PatchQueue
+from daikin_schedule import PollScheduler
+from daikin_store import Store
 
 _logger = logging.getLogger(__name__)
 
@@ -31,40 +37,61 @@ def setup_logging(zf):
 
 
 def monitor():
-    daikin = Daikin()
+    # serve or dump metrics if $DAIKIN_METRICS says so
+    export_from_env()
+
+    # share gateway-devices with any other scripts polling at the same time
+    # (the scheduler lines polls up with the clock, so they coincide, and
+    # the ttl needs to be less than the shortest interval)
+    daikin = Daikin(cache_ttl=240)
+    # and keep the samples in binary form, for analysis later
+    store = Store()
+    # along with the raw results, as deltas, for debugging and replay
+    archive = Archive()
+    # and send any changes that are waiting for quota
+    patches = PatchQueue(daikin)
+    # and decide how often to poll, according to quota and activity
+    scheduler = PollScheduler(daikin.quota)
+    # get the connections open while there's nothing else to do
+    daikin.warm_up()
 
     while True:
-        mp = daikin.management_points()
-
-        mz = mp["climateControlMainZone"]["sensoryData"]["value"]
-        lwt = mz["leavingWaterTemperature"]["value"]
-        outdoor = mz["outdoorTemperature"]["value"]
-        room = mz["roomTemperature"]["value"]
-
-        tc = mp["climateControlMainZone"]["temperatureControl"]["value"]
-        # should this be "auto", or "heating" ?
-        target = tc["operationModes"]["auto"]["setpoints"]["roomTemperature"]["value"]
-        offs = tc["operationModes"]["auto"]["setpoints"]["leavingWaterOffset"]["value"]
-
-        hwt = mp["domesticHotWaterTank"]["sensoryData"]["value"]
-        hw = hwt["tankTemperature"]["value"]
-
-        # now = datetime.now()
-        _logger.info(
-            "outdoor=%2d room=%2.1f / %2.1f hw=%d  lwt=%d (offs=%d)",
-            outdoor,
-            room,
-            target,
-            hw,
-            lwt,
-            offs,
-        )
+        ok, gw = scheduler.poll(daikin.poll, daikin.device)
+        if not ok:
+            # skip this sample rather than dying - try again next time
+            scheduler.sleep()
+            continue
+        now = time.time()
+
+        if gw is None:
+            # exactly the same as last time (which can't be the first
+            # time round) - nothing new to log or store
+            _logger.debug("no change")
+        else:
+            archive.record(now, gw)
+            s = SENSORS.extract(gw, daikin.device)
+            if s.complete():
+                _logger.info(
+                    "outdoor=%2d room=%2.1f / %2.1f hw=%d  lwt=%d (offs=%d)",
+                    s.outdoor,
+                    s.room,
+                    s.target,
+                    s.hw,
+                    s.lwt,
+                    s.offset,
+                )
+            else:
+                _logger.warning("Hmm - incomplete results: %s", s)
+            store.append(now, **s.as_dict())
+        patches.flush()
 
         # API requests are limited to 200 per day
         # They suggest one per 10 minutes, which leaves around 50 for
         # actually controlling the system. Or perhaps downloading
         # consumption figures at the end of the day.
-        time.sleep(600)
+        # The scheduler keeps us within that, but polls more often
+        # when things are changing, and less often overnight.
+        scheduler.sleep()
 
 
 def main():
@@ -3,15 +3,22 @@
 """A simple script to print some state every 10 minutes.
 
 The temperatures come from the daikin site.
-The power consumption comes from myenergi.
+The power consumption comes from myenergi, which is read every minute
+(see daikin_collect.py) - the log shows the mean since the last line,
+and the store gets the individual readings too.
 """
 
 from datetime import datetime
-import time
 import logging
 import gzip
 
 from daikin import Daikin
+from daikin_archive import Archive
+from daikin_collect import Aligner, Collector, DaikinSource, FunctionSource
+from daikin_metrics import export_from_env
+from daikin_patches import PatchQueue
+from daikin_schedule import PollScheduler
+from daikin_store import Store
 from myenergi import MyenergiApi
 
 _logger = logging.getLogger(__name__)
@@ -36,55 +43,62 @@ def setup_logging(zf):
 
 
 def monitor():
-    daikin = Daikin()
+    # serve or dump metrics if $DAIKIN_METRICS says so
+    export_from_env()
+
+    # share gateway-devices with any other scripts polling at the same time
+    # (the scheduler lines polls up with the clock, so they coincide, and
+    # the ttl needs to be less than the shortest interval)
+    daikin = Daikin(cache_ttl=240)
+    # and keep the samples in binary form, for analysis later
+    store = Store()
+    # along with the raw results, as deltas, for debugging and replay
+    archive = Archive()
+    # and send any changes that are waiting for quota
+    patches = PatchQueue(daikin)
+    # and decide how often to poll, according to quota and activity
+    scheduler = PollScheduler(daikin.quota)
+    # get the connections open while there's nothing else to do
+    daikin.warm_up()
     myenergi = MyenergiApi()
 
-    while True:
+    def read_power():
         # heatpump is attached to CT#2
         # direction is backwards so that app animates it correctly
         stat = myenergi.get("/cgi-jstatus-Z")
-        zappi = stat["zappi"][0]
-        power = -zappi["ectp3"]
-
-        mp = daikin.management_points()
-
-        # from time to time this produces empty results
-        try:
-            sd = mp["climateControlMainZone"]["sensoryData"]["value"]
-            lwt = sd["leavingWaterTemperature"]["value"]
-            outdoor = sd["outdoorTemperature"]["value"]
-            room = sd["roomTemperature"]["value"]
-
-            tc = mp["climateControlMainZone"]["temperatureControl"]["value"]
-            # should this be "auto", or "heating" ?
-            target = tc["operationModes"]["auto"]["setpoints"]["roomTemperature"]["value"]
-            offs = tc["operationModes"]["auto"]["setpoints"]["leavingWaterOffset"]["value"]
-
-            tc = mp["climateControlMainZone"]["temperatureControl"]["value"]
-            # should this be "auto", or "heating" ?
-            target = tc["operationModes"]["auto"]["setpoints"]["roomTemperature"]["value"]
-
-            hwt = mp["domesticHotWaterTank"]["sensoryData"]["value"]
-            hw = hwt["tankTemperature"]["value"]
-
+        return {"power": -stat["zappi"][0]["ectp3"]}
+
+    # myenergi doesn't have a limit like the Daikin, so it can be read
+    # every minute, with the Daikin polled as the scheduler decides
+    collector = Collector(
+        [
+            DaikinSource(daikin, scheduler, archive, patches),
+            FunctionSource("zappi", 60, read_power),
+        ]
+    )
+    aligner = Aligner("daikin")
+
+    for sample in collector.samples():
+        if sample.source == "zappi":
+            store.append(sample.time, **sample.values)
+        aligned = aligner.add(sample)
+        if aligned is None:
+            continue
+
+        # the Daikin values, with the mean power since the last poll
+        v = aligned.values
+        store.append(aligned.time, **v)
+        if None not in v.values() and "power" in v:
             _logger.info(
                 "power=%4d outdoor=%2d room=%2.1f / %2.1f hw=%d  lwt=%d (offs=%d)",
-                power,
-                outdoor,
-                room,
-                target,
-                hw,
-                lwt,
-                offs,
+                v["power"],
+                v["outdoor"],
+                v["room"],
+                v["target"],
+                v["hw"],
+                v["lwt"],
+                v["offset"],
             )
-        except KeyError:
-            _logger.warning("Hmm - got a key error")
-
-        # Daikin API requests are limited to 200 per day
-        # They suggest one per 10 minutes, which leaves around 50 for
-        # actually controlling the system. Or perhaps downloading
-        # consumption figures at the end of the day.
-        time.sleep(600)
 
 
 def main():
@@ -14,13 +14,95 @@ import os
 import requests
 import time
 import sys
+import threading
 
-from requests.adapters import HTTPAdapter, Retry
-from typing import TextIO
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Iterator, List, Optional, TextIO
+
+import daikin_broker
+
+from daikin_archive import digest, flatten
+from daikin_cache import ResponseCache
+from daikin_fields import SENSORS, FieldSpec, Snapshot
+from daikin_metrics import emit
+from daikin_patches import PatchQueue
+from daikin_quota import Quota, QuotaExceeded
+from daikin_transport import Transport
+from daikin_watch import ChangeEvent, Watcher
 
 _logger = logging.getLogger(__name__)
 
 
+def _complete(gw: list, previous: list) -> bool:
+    """Sanity-check a gateway-devices result before it replaces a good one.
+
+    From time to time the api returns an empty list, or management points
+    with bits missing. So check that we have at least everything we had
+    last time.
+    """
+
+    if not gw or not all(g.get("managementPoints") for g in gw):
+        return False
+    if not previous:
+        return True
+
+    new = {
+        (g["id"], mp["embeddedId"]): mp.keys() for g in gw for mp in g["managementPoints"]
+    }
+    for g in previous:
+        for mp in g["managementPoints"]:
+            keys = new.get((g["id"], mp["embeddedId"]))
+            if keys is None or not mp.keys() <= keys:
+                return False
+    return True
+
+
+def _endpoint(url: str) -> str:
+    """The api endpoint a url is for, with any ids taken out - for
+    reporting requests against, eg gateway-devices/{id}"""
+    parts = url.split("?")[0].split("/v1/", 1)[-1].split("/")
+    if parts[0] == "gateway-devices" and len(parts) > 1:
+        parts[1] = "{id}"
+    return "/".join(parts)
+
+
+class DeviceIndex:
+    """An index over all the gateway devices from one gateway-devices response.
+
+    Management points can be looked up by (device id, embeddedId),
+    and characteristics by (device id, embeddedId, characteristic).
+    """
+
+    def __init__(self, gw: list):
+        self.gateways = {g["id"]: g for g in gw}
+        self.points = {
+            (g["id"], mp["embeddedId"]): mp
+            for g in gw
+            for mp in g.get("managementPoints", [])
+        }
+
+    def __iter__(self) -> Iterator[str]:
+        """The device ids, in the order the api gave them"""
+        return iter(self.gateways)
+
+    def __len__(self) -> int:
+        return len(self.gateways)
+
+    def __getitem__(self, key: tuple):
+        """index[device, embeddedId] or index[device, embeddedId, characteristic]"""
+        if len(key) == 3:
+            return self.points[key[0], key[1]][key[2]]
+        return self.points[key]
+
+    def first(self) -> Optional[str]:
+        return next(iter(self.gateways), None)
+
+    def management_points(self, device: Optional[str] = None) -> dict:
+        """The management points for one device (default the first), keyed by embeddedId"""
+        g = self.gateways[device or self.first()]
+        return {mp["embeddedId"]: mp for mp in g.get("managementPoints", [])}
+
+
 class Daikin:
     """Daikin Cloud API access.
 
@@ -32,8 +114,10 @@ class Daikin:
     Getting started from scratch requires interactive authentication
     using a browser - see main()
 
-    Does not do anything about trying to manage the rate-limiting
-    that the API enforces.
+    Every request is also counted against the rate-limit that the
+    API enforces, using a ledger shared with any other processes
+    (see daikin_quota.py). A request which would go over the limit
+    raises QuotaExceeded rather than being sent.
     """
 
     # configuration
@@ -54,11 +138,33 @@ class Daikin:
     # (Losing it isn't particularly serious.)
     key_file = pathlib.Path("/tmp/daikin_key.json")
 
+    # The (locked) json file used to share the api quota between processes.
+    quota_file = key_file.with_name("daikin_quota.json")
+
+    # Where gateway-devices responses are cached, if caching is turned on.
+    cache_file = key_file.with_name("daikin_gateway_devices.json")
+
+    # Where the token broker listens, if it's running (see daikin_broker.py)
+    broker_socket = key_file.with_name("daikin_broker.sock")
+
     # The daikin url prefixes
     # Can use the 'mock' version of the api url while experimenting.
     idp_url = "https://idp.onecta.daikineurope.com/v1/oidc"
     api_url = "https://api.onecta.daikineurope.com/v1"
 
+    # Where management points can be fetched from - everything, or all of
+    # one gateway device. Once we know the device id, the second is used,
+    # which leaves out any other gateway devices on the account. (There's no
+    # GET for a single management point - they can only be PATCHed - so
+    # that's as narrow as it gets.) The cache holds the full list, to share
+    # with other processes, so with that on it's always the first.
+    endpoints = {"all": "gateway-devices", "device": "gateway-devices/{device}"}
+
+    # How many requests can be in flight at once - from get_many(), or
+    # several threads sharing one Daikin. It's the size of the connection
+    # pool, so they each get a connection rather than waiting for one.
+    pool_size = 4
+
     app: dict  # the in-memory copy of app_file
     key: dict  # the in-memory copy of key_file
 
@@ -66,9 +172,49 @@ class Daikin:
     key_modtime: int  # the mod time of key_file when we loaded it
     key_expiry: int  # based on mod time plus "expires_after" (3600 seconds)
 
-    session: requests.Session  # for persisting api connections
+    transport: Transport  # keeps the connections to the idp and api open
+    quota: Quota  # the shared rate-limit ledger
+    cache: ResponseCache  # shared copy of gateway-devices, or None
+    broker: bool  # whether we're getting keys from the broker
+
+    # the latest gateway devices we've fetched, and when
+    index: DeviceIndex = None
+    index_time: float = 0
+    last_digest: str = None  # of the state poll() last returned
+    watcher: Watcher = None  # does the polling for watch(), once it's used
+
+    def __init__(self, cache_ttl: float = 0, use_broker: bool = True):
+        """cache_ttl, if given, is how many seconds a gateway-devices
+        response can be shared between processes (see daikin_cache.py)
+
+        If use_broker is set and the token broker is running, keys come
+        from that and the app and key files aren't read at all.
+        """
+
+        # guards the key, and the latest gateway devices, between threads.
+        # Also held while refreshing the key, so only one thread does that.
+        self._lock = threading.RLock()
+
+        self.broker = False
+        reply = None
+        if use_broker:
+            reply = daikin_broker.ask(self.broker_socket, {"op": "token"})
+        if reply and "access_token" in reply:
+            self.broker = True
+            self._use_broker_key(reply)
+            self.app = dict()
+            self.id = self.secret = None
+            self.device = reply["device"]
+        else:
+            self._load_files()
 
-    def __init__(self):
+        self.transport = self._make_transport()
+
+        self.quota = Quota(self.quota_file)
+        self.cache = ResponseCache(self.cache_file, cache_ttl) if cache_ttl else None
+
+    def _load_files(self) -> None:
+        """Load the app details and the key from their files"""
         with self.app_file.open() as af:
             self.app = json.load(af)
 
@@ -88,11 +234,34 @@ class Daikin:
             self.key_modtime = 0
             self.key_expiry = 0
 
-        session = requests.Session()
-        session.headers.update({"Accept-Encoding": "gzip"})
-        retries = Retry(total=5, backoff_factor=5)
-        session.mount(self.api_url, HTTPAdapter(max_retries=retries))
-        self.session = session
+    def _use_broker_key(self, reply: dict) -> None:
+        self.key = {"access_token": reply["access_token"]}
+        self.key_modtime = 0
+        self.key_expiry = reply["expires_at"]
+
+    def _key_from_broker(self) -> bool:
+        """Ask the broker for the current key.
+
+        Returns False if it seems to have gone away, in which case
+        we go back to using the files.
+        """
+        reply = daikin_broker.ask(self.broker_socket, {"op": "token"})
+        if reply and "access_token" in reply:
+            self._use_broker_key(reply)
+            return True
+        _logger.warning("token broker not responding - using key file instead")
+        self.broker = False
+        device = self.device
+        self._load_files()
+        self.device = self.device or device
+        return False
+
+    def _make_transport(self) -> Transport:
+        return Transport(pool_size=self.pool_size)
+
+    def warm_up(self) -> None:
+        """Connect to the servers now, for scripts which will be using them"""
+        self.transport.warm_up(self.api_url, *([] if self.broker else [self.idp_url]))
 
     def load_key_file(self, kf: TextIO) -> None:
         """Load the key file, and calculate expiry time.
@@ -107,6 +276,20 @@ class Daikin:
         self.key_modtime = os.stat(kf.fileno()).st_mtime
         self.key_expiry = self.key_modtime + self.key["expires_in"] - 30
 
+    def _token_args(self, code=None) -> dict:
+        """The parameters for a request to the token endpoint"""
+        args = {"client_id": self.id, "client_secret": self.secret}
+        if code:
+            # it's a new code
+            args["grant_type"] = "authorization_code"
+            args["code"] = code
+            args["redirect_uri"] = self.redir
+        else:
+            # a refresh
+            args["grant_type"] = "refresh_token"
+            args["refresh_token"] = self.key["refresh_token"]
+        return args
+
     def _get_or_refresh_key(self, code=None) -> str:
         """Generate or refresh access token.
 
@@ -119,19 +302,9 @@ class Daikin:
         about the locking...)
         """
 
-        args = {"client_id": self.id, "client_secret": self.secret}
-        if code:
-            # it's a new code
-            args["grant_type"] = "authorization_code"
-            args["code"] = code
-            args["redirect_uri"] = self.redir
-        else:
-            # a refresh
-            args["grant_type"] = "refresh_token"
-            args["refresh_token"] = self.key["refresh_token"]
-
-        url = self.idp_url + "/token?" + "&".join(f"{a}={b}" for a, b in args.items())
-        r = requests.post(url, timeout=30)
+        r = self.transport.request(
+            "POST", self.idp_url + "/token", params=self._token_args(code)
+        )
         r.raise_for_status()
         return r.text
 
@@ -147,13 +320,38 @@ class Daikin:
         self.key = json.loads(j)
         self.key_expiry = self.key_modtime + self.key["expires_in"] - 30
 
-    def check_key_expiry(self) -> None:
-        """Check whether key has expired, and try to update if necessary."""
-        now = time.time()
-        if now < self.key_expiry:
+    def _key_expired(self, margin: float = 0) -> bool:
+        return time.time() + margin >= self.key_expiry
+
+    def check_key_expiry(self, margin: float = 0) -> None:
+        """Check whether key has expired, and try to update if necessary.
+
+        With margin, it is refreshed if it will expire within that many seconds.
+
+        Safe to call from several threads: the first to find the key
+        expired refreshes it, and the others wait for that and use the
+        new key, rather than all using up the refresh token.
+        """
+        if not self._key_expired(margin):
             # still good.
             return
 
+        with self._lock:
+            if not self._key_expired(margin):
+                # another thread has just refreshed it
+                return
+            self._refresh_key(margin)
+
+    def _refresh_key(self, margin: float) -> None:
+        """The rest of check_key_expiry(), with the lock held"""
+        if self.broker:
+            if self._key_from_broker():
+                # refreshing it is the broker's job
+                return
+            if not self._key_expired(margin):
+                # broker has gone, but the key file is good
+                return
+
         with self.key_file.open(mode="r+") as kf:
             fd = kf.fileno()
 
@@ -166,110 +364,340 @@ class Daikin:
             # not really an issue. (On linux, at least...)
             # I guess I could also do it as a try... finally
 
+            start = time.perf_counter()
             fcntl.flock(fd, fcntl.LOCK_EX)
+            emit("lock", name="key", seconds=time.perf_counter() - start)
 
-            modtime = os.fstat(fd).st_mtime
-            if modtime > self.key_modtime:
-                # seems that another process has already updated the file
-                self.load_key_file(kf)
-
-                now = time.time()  # flock() might have blocked for a while
-                if now < self.key_expiry:
-                    # new key is good
-                    fcntl.flock(
-                        fd, fcntl.LOCK_UN
-                    )  # not really needed - lock vanishes on close
-                    return
-                # else update happened too long ago..?
+            if self._reload_if_newer(kf, margin):
+                # seems that another process has already refreshed it
+                return
 
             _logger.info("need to refresh key")
-            j = self._get_or_refresh_key()
-
-            kf.seek(0)
-            print(j, file=kf)
-            kf.truncate()  # in case new data was shorter
-            kf.flush()
-            self.key_modtime = os.fstat(fd).st_mtime
-            fcntl.flock(fd, fcntl.LOCK_UN)  # happens automatically at close anyway
-
+            try:
+                j = self._get_or_refresh_key()
+            except Exception:
+                emit("refresh", ok=False)
+                raise
+            emit("refresh", ok=True)
+            self._store_key(kf, j)
+
+    def _reload_if_newer(self, kf: TextIO, margin: float = 0) -> bool:
+        """Reload the (locked) key file if another process has updated it.
+
+        Returns True if that gave us a key which is still good
+        (for at least margin seconds).
+        """
+        modtime = os.fstat(kf.fileno()).st_mtime
+        if modtime <= self.key_modtime:
+            return False
+        self.load_key_file(kf)
+        # flock() might have blocked for a while
+        # (or else update happened too long ago..?)
+        return not self._key_expired(margin)
+
+    def _store_key(self, kf: TextIO, j: str) -> None:
+        """Write a new key (as json string) to the locked key file and start using it"""
+        kf.seek(0)
+        print(j, file=kf)
+        kf.truncate()  # in case new data was shorter
+        kf.flush()
+        self.key_modtime = os.fstat(kf.fileno()).st_mtime
         self.key = json.loads(j)
         self.key_expiry = self.key_modtime + self.key["expires_in"] - 30
 
-    def get(self, command: str) -> dict:
+    def get(self, command: str, deadline: Optional[float] = None) -> dict:
         """Perform a get on an api leaf.
         Return the output as a dictionary.
         """
+        return json.loads(self.get_raw(command, deadline))
+
+    def get_many(
+        self,
+        commands: List[str],
+        deadline: Optional[float] = None,
+        max_workers: Optional[int] = None,
+    ) -> list:
+        """get() each of the commands, several at a time (no more than
+        pool_size), and return the results in the same order.
+
+        Each one still goes through the quota, so this doesn't make more
+        requests than doing them one after another - they just don't wait
+        for each other. If any fail, the first exception is raised.
+        """
+        workers = min(max_workers or self.pool_size, self.pool_size, len(commands))
+        if workers <= 1:
+            return [self.get(c, deadline) for c in commands]
+        # one refresh up front, rather than all of the workers wanting one
+        self.check_key_expiry()
+        with ThreadPoolExecutor(workers, thread_name_prefix="daikin") as pool:
+            return list(pool.map(lambda c: self.get(c, deadline), commands))
+
+    def get_raw(self, command: str, deadline: Optional[float] = None) -> bytes:
+        """Perform a get on an api leaf, and return the raw response body.
+
+        deadline, if given, is the time.time() by which to give up
+        (see daikin_transport.py)
+        """
         self.check_key_expiry()
         url = self.api_url + "/" + command
-        headers = {"Authorization": "Bearer " + self.key["access_token"]}
-        r = self.session.request("GET", url, headers=headers, timeout=30)
+        headers = self._auth_headers()
+        r = self.transport.request(
+            "GET",
+            url,
+            deadline,
+            self._record,
+            self._spend(False, deadline),
+            headers=headers,
+        )
         r.raise_for_status()
-        # print(r.text)
-        return json.loads(r.text)
-
-    def patch(self, name: str, **payload) -> None:
+        return r.content
+
+    def _auth_headers(self) -> dict:
+        with self._lock:
+            return {"Authorization": "Bearer " + self.key["access_token"]}
+
+    def _spend(self, write: bool, deadline: Optional[float]):
+        """A before hook for Transport.request(), so that every attempt
+        (retries too) takes a token from the quota"""
+
+        def before(attempt: int) -> None:
+            remaining = self.quota.acquire(write, max_wait=self._wait(deadline))
+            emit("quota", remaining=remaining)
+
+        return before
+
+    def _wait(self, deadline: Optional[float]) -> Optional[float]:
+        """How long we can wait for quota, if there's a deadline"""
+        if deadline is None:
+            return None
+        return max(0.0, min(self.quota.max_wait, deadline - time.time()))
+
+    def _record(self, r: requests.Response, attempt: int, seconds: float) -> None:
+        """Note the outcome of a request, for the quota and the metrics"""
+        endpoint = _endpoint(r.request.url)
+        # the body, and what it took over the wire (less, if it was gzipped)
+        size, wire = len(r.content), r.raw.tell() if r.raw else 0
+        _logger.debug(
+            "%s %s: %d bytes (%d on the wire) in %.2fs",
+            r.request.method,
+            endpoint,
+            size,
+            wire,
+            seconds,
+        )
+        emit(
+            "request",
+            method=r.request.method,
+            endpoint=endpoint,
+            status=r.status_code,
+            seconds=seconds,
+            bytes=size,
+            wire_bytes=wire,
+            retries=1 if attempt > 1 else 0,
+        )
+        remaining = self.quota.update(r.status_code, r.headers)
+        if remaining is not None:
+            emit("quota", remaining=remaining)
+
+    def patch(
+        self,
+        name: str,
+        device: Optional[str] = None,
+        deadline: Optional[float] = None,
+        **payload,
+    ) -> None:
         """Perform a patch on a management id
         Additional keyword parameters are sent as the body payload.
+
+        device is the gateway device id - defaults to the configured one.
         """
-        if self.device is None:
+        device = device or self.device
+        if device is None:
             raise ValueError("need to configure device")
         self.check_key_expiry()
-        url = f"{self.api_url}/gateway-devices/{self.device}/management-points/{name}"
-        headers = {"Authorization": "Bearer " + self.key["access_token"]}
-        r = self.session.request("PATCH", url, headers=headers, json=payload, timeout=30)
+        url = f"{self.api_url}/gateway-devices/{device}/management-points/{name}"
+        headers = self._auth_headers()
+        r = self.transport.request(
+            "PATCH",
+            url,
+            deadline,
+            self._record,
+            self._spend(True, deadline),
+            headers=headers,
+            json=payload,
+        )
         r.raise_for_status()
 
-    def management_points(self):
-        """Return the "managePoints" from the first gateway device.
+    def gateway_devices(self, deadline: Optional[float] = None) -> list:
+        """Get the list of gateway devices, from the cache if it's enabled"""
+        if self.cache is None:
+            return self.get("gateway-devices", deadline)
+        return self.cache.get(lambda: self.get("gateway-devices", deadline), _complete)
+
+    def devices(self) -> DeviceIndex:
+        """Fetch gateway-devices, and index all the devices in it.
+
+        This is the one request needed to get at everything, however
+        many gateway devices there are.
+        """
+        return self._make_index(self.gateway_devices(), time.time())
+
+    def endpoint(self, device: Optional[str] = None) -> str:
+        """The narrowest endpoint with all of a device's management points"""
+        device = device or self.device
+        if device is None or self.cache is not None:
+            return self.endpoints["all"]
+        return self.endpoints["device"].format(device=device)
+
+    def gateway_device(
+        self, device: Optional[str] = None, deadline: Optional[float] = None
+    ) -> dict:
+        """Get one gateway device (default the configured one) on its own"""
+        device = device or self.device
+        if device is None:
+            raise ValueError("need to configure device")
+        g = self.get(self.endpoints["device"].format(device=device), deadline)
+        self._merge_device(g, time.time())
+        return g
+
+    def poll(self, deadline: Optional[float] = None) -> Optional[list]:
+        """Fetch gateway-devices, but return None if nothing has changed
+        since the last time this was called.
+
+        Most polls only see a few values change, and often none at all,
+        so this saves parsing and logging the same thing again.
+        (Things like lastUpdateReceived, which change every time anyway,
+        are ignored.)
+        """
+        gw = self.gateway_devices(deadline)
+        d = digest(flatten(gw))
+        with self._lock:
+            if d == self.last_digest:
+                return None
+            self.last_digest = d
+            self._make_index(gw, time.time())
+        return gw
+
+    def watch(
+        self, paths: Iterable[str], device: Optional[str] = None
+    ) -> Iterator[ChangeEvent]:
+        """Poll for ever, yielding a ChangeEvent whenever one of the values
+        under paths changes (see daikin_watch.py). Any number of these can
+        be going at once, from different threads - they share the polls."""
+        with self._lock:
+            if self.watcher is None:
+                self.watcher = Watcher(self)
+        return self.watcher.watch(paths, device)
+
+    def management_points(self, device: Optional[str] = None) -> dict:
+        """Return the "managePoints" from a gateway device - the configured one,
+        or the first one, unless another is given.
 
         The raw output from gateway-devices contains an array of managementPoints
         but it's convenient to access them by their type, so pack them into
         a dictionary, keyed on "embeddedId", which are things like "climateControlMainZone"
         or "domesticHotWaterTank".
+
+        Once the device id is known, only that device is fetched (see endpoint()).
         """
+        device = device or self.device
+        if self.endpoint(device) == self.endpoints["all"]:
+            return self.devices().management_points(device)
+        return DeviceIndex([self.gateway_device(device)]).management_points(device)
 
-        gw = self.get("gateway-devices")
+    def known_state(self, device: Optional[str] = None):
+        """The most recent management points we know about for a device,
+        without making a request, and the time they were fetched. That's either
+        the ones we last fetched, or the ones in the cache if they're newer.
 
-        # assume there's just one gateway device
+        Returns (None, 0) if we've got nothing.
+        """
+        with self._lock:
+            index, stamp = self.index, self.index_time
+        if self.cache is not None:
+            snap = self.cache.load()
+            if snap and snap["data"] and snap["stamp"] > stamp:
+                index, stamp = DeviceIndex(snap["data"]), snap["stamp"]
+        if index is None:
+            return None, 0
+        return index.management_points(device or self.device), stamp
+
+    def _make_index(self, gw: list, stamp: float) -> DeviceIndex:
+        """Index a gateway-devices result, and remember it as the latest"""
+        index = DeviceIndex(gw)
+        with self._lock:
+            if stamp >= self.index_time:
+                self.index, self.index_time = index, stamp
+
+            if self.device is None:
+                # no device configured - stash the id of the first gateway
+                # for later
+                self.device = index.first()
+                _logger.info("gateway device id is %s", self.device)
+
+        return index
+
+    def _merge_device(self, g: dict, stamp: float) -> None:
+        """Put a single gateway device into the latest index, in place of
+        the old copy of it (the others are left as they were, though the
+        index time says otherwise)"""
+        with self._lock:
+            gw = list(self.index.gateways.values()) if self.index is not None else []
+            if not any(old["id"] == g["id"] for old in gw):
+                gw.append(g)
+            self._make_index([g if old["id"] == g["id"] else old for old in gw], stamp)
+
+    def read_fields(self, spec: FieldSpec, device: Optional[str] = None) -> Snapshot:
+        """Fetch the device (see endpoint()) and extract just the fields in spec.
+
+        Without the cache, the response is parsed straight into the snapshot
+        without building the whole tree. (With it, the cache has already
+        parsed it anyway.)
+        """
+        device = device or self.device
+        if self.cache is None:
+            # either the list, or one gateway device on its own
+            gw = spec.parse(self.get_raw(self.endpoint(device)))
+            return spec.extract(gw if isinstance(gw, list) else [gw], device)
+        return spec.extract(self.gateway_devices(), device)
 
-        if self.device is None:
-            # no device configured - stash the id of the first gateway
-            # for later
-            self.device = gw[0]["id"]
-            _logger.info("gateway device id is %s", self.device)
+    def read_all_fields(self, spec: FieldSpec) -> dict:
+        """Like read_fields(), but for every gateway device, from the one request.
 
-        return {item["embeddedId"]: item for item in gw[0]["managementPoints"]}
+        Returns a dictionary of snapshots keyed on device id.
+        """
+        if self.cache is None:
+            gw = spec.parse(self.get_raw("gateway-devices"))
+        else:
+            gw = self.gateway_devices()
+        return {g["id"]: spec.extract([g]) for g in gw}
 
-    def set_temperature_control(self, name, value):
+    def set_temperature_control(self, name, value, device: Optional[str] = None):
         """Patch a temperature control = either "roomTemperature" or "leavingWaterOffset" """
         self.patch(
             "climateControlMainZone/characteristics/temperatureControl",
+            device,
             path="/operationModes/heating/setpoints/" + name,
             value=value,
         )
 
-
-    def set_powerful_mode(self, state):
+    def set_powerful_mode(self, state, device: Optional[str] = None):
         """Turn water immersion heater on or off"""
         self.patch(
             "domesticHotWaterTank/characteristics/powerfulMode",
-            value = "on" if state else "off"
+            device,
+            value="on" if state else "off",
         )
 
-def main():
-    """Entry point if invoked as a script"""
-
-    if len(sys.argv) == 1 or sys.argv[1] == "help":
-        print(
-            f"Usage: {sys.argv[0]} code [token] |refresh | get XXX | sensors | mp | debug | temp [value] | lwo [value] | powerful [0|1]"
-        )
-        return
 
-    logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
-
-    daikin = Daikin()
+def run(daikin: Daikin, argv: list, out: Optional[TextIO] = None) -> None:
+    """Carry out a command from the command line (argv without the script
+    name), printing any output to out. This is also how the broker runs
+    commands for daikin-cli.py, with its warm Daikin.
+    """
+    out = out or sys.stdout
 
-    if sys.argv[1] == "code":
+    if argv[0] == "code":
         # this is used to bootstrap the authentication system.
         # Invoked with just code, it prints the url need to paste
         # into your browser to authenticate. That will result
@@ -278,81 +706,97 @@ def main():
         #
         # You can then re-invoke with code and add this value.
 
-        if len(sys.argv) == 2:
+        if len(argv) == 1:
             print(
-                "To generate a new code, open brower with this url, then reinvoke and add the new code as a parameter\n"
+                "To generate a new code, open brower with this url, then reinvoke and add the new code as a parameter\n",
+                file=out,
             )
             print(
                 f"{daikin.idp_url}/authorize"
                 "?response_type=code"
                 "&scope=openid%20onecta:basic.integration"
                 f"&client_id={daikin.app['id']}"
-                f"&redirect_uri={daikin.redir}"
+                f"&redirect_uri={daikin.redir}",
+                file=out,
             )
         else:
             # we have a new code - need to turn it into credentials
-            daikin.get_new_key(code=sys.argv[2])
+            daikin.get_new_key(code=argv[1])
 
-    elif sys.argv[1] == "refresh":
+    elif argv[0] == "refresh":
         # refresh the key if necessary.
         # Should happen automatically, so don't really need to
         # do it explicitly.
-        daikin.get_or_refresh_key()
-
-    elif sys.argv[1] == "sensors":
-        mp = daikin.management_points()
+        daikin.check_key_expiry()
 
-        sd = mp["climateControlMainZone"]["sensoryData"]["value"]
-        lwt = sd["leavingWaterTemperature"]["value"]
-        outdoor = sd["outdoorTemperature"]["value"]
-        room = sd["roomTemperature"]["value"]
-
-        tc = mp["climateControlMainZone"]["temperatureControl"]["value"]
-        # should this be "auto", or "heating" ?
-        target = tc["operationModes"]["auto"]["setpoints"]["roomTemperature"]["value"]
-
-        hwt = mp["domesticHotWaterTank"]["sensoryData"]["value"]
-        hw = hwt["tankTemperature"]["value"]
-        print(f"outdoor={outdoor}, room={room} / {target}, hw={hw}, lwt={lwt}")
+    elif argv[0] == "sensors":
+        s = daikin.read_fields(SENSORS)
+        print(
+            f"outdoor={s.outdoor}, room={s.room} / {s.target}, hw={s.hw}, lwt={s.lwt}",
+            file=out,
+        )
 
-    elif sys.argv[1] == "get":
-        if len(sys.argv) == 2:
-            print("Usage: get info | sites | gateway-devices | ...")
+    elif argv[0] == "get":
+        if len(argv) == 1:
+            print("Usage: get info | sites | gateway-devices | ...", file=out)
             return
 
         # perform a GET on an API url
-        d = daikin.get(sys.argv[2])
-        print(json.dumps(d, indent=4))
+        d = daikin.get(argv[1])
+        print(json.dumps(d, indent=4), file=out)
 
-    elif sys.argv[1] == "mp":
+    elif argv[0] == "mp":
         mp = daikin.management_points()
-        print(json.dumps(mp, indent=4))
+        print(json.dumps(mp, indent=4), file=out)
 
-    elif sys.argv[1] == "temp":
-        temp = float(sys.argv[2])
+    elif argv[0] == "temp":
+        temp = float(argv[1])
         daikin.set_temperature_control("roomTemperature", value=temp)
 
-    elif sys.argv[1] == "lwo":
-        lwo = int(sys.argv[2])
+    elif argv[0] == "lwo":
+        lwo = int(argv[1])
         daikin.set_temperature_control("leavingWaterOffset", value=lwo)
 
-    elif sys.argv[1] == "powerful":
-        state = int(sys.argv[2])
+    elif argv[0] == "powerful":
+        state = int(argv[1])
         daikin.set_powerful_mode(state)
 
-    elif sys.argv[1] == "debug":
-        print(json.dumps(daikin.app, indent=4))
-        print(json.dumps(daikin.key, indent=4))
+    elif argv[0] == "flush":
+        # send any changes queued up by PatchQueue (see daikin_patches.py)
+        pending = PatchQueue(daikin).flush(force=True)
+        print(f"{pending} changes still pending", file=out)
+
+    elif argv[0] == "debug":
+        print(json.dumps(daikin.app, indent=4), file=out)
+        print(json.dumps(daikin.key, indent=4), file=out)
         now = time.time()
         if now < daikin.key_expiry:
             delta = daikin.key_expiry - now
-            print(f"key expires in {delta} seconds")
+            print(f"key expires in {delta} seconds", file=out)
         else:
             ago = now - daikin.key_expiry
-            print(f"key expired {ago} seconds ago")
+            print(f"key expired {ago} seconds ago", file=out)
+        print(f"quota remaining: {daikin.quota.remaining():.1f} requests", file=out)
 
     else:
-        print("Unknown request: ", sys.argv[1])
+        print("Unknown request: ", argv[0], file=out)
+
+
+def main():
+    """Entry point if invoked as a script"""
+
+    if len(sys.argv) == 1 or sys.argv[1] == "help":
+        print(
+            f"Usage: {sys.argv[0]} code [token] |refresh | get XXX | sensors | mp | debug | temp [value] | lwo [value] | powerful [0|1] | flush"
+        )
+        return
+
+    logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
+
+    # these need the real config and key files, rather than the broker
+    daikin = Daikin(use_broker=sys.argv[1] not in ("code", "refresh", "debug"))
+
+    run(daikin, sys.argv[1:])
 
 
 if __name__ == "__main__":
@@ -0,0 +1,176 @@
+"""Look after several Daikin accounts (households) from one process.
+
+The Daikin class has its app, key and quota files at fixed paths, so
+one process can only talk for one household. Here each account has a
+directory of its own:
+
+    ~/.daikin_accounts/<name>/app.json     - as ~/.daikin_app.json
+                             /key.json     - as /tmp/daikin_key.json
+                             /quota.json   - the account's own ledger
+
+(To set one up, run `daikin.py code` as usual, and copy the two files in.)
+
+Each Account is a Daikin in its own right, with its own key lock and
+quota, but they all share one Transport, so there's one pool of
+connections to the api however many accounts there are. Likewise the
+polls are made by a few worker threads, rather than a thread per account,
+and the gateway devices aren't kept once they've been handled.
+
+Each account has its own PollScheduler, working from its own quota. The
+scheduler's intervals are all multiples of 5 minutes, lined up with the
+clock, so each account is given its own offset within those 5 minutes -
+otherwise they would all poll at once on the hour, then again at 10 past.
+
+    manager = AccountManager()
+    manager.load()
+    manager.run(lambda account, gw: print(account.name, len(gw)))
+"""
+
+import heapq
+import logging
+import pathlib
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Optional
+
+from daikin import Daikin
+from daikin_fields import SENSORS
+from daikin_schedule import PollScheduler
+from daikin_transport import Transport
+
+_logger = logging.getLogger(__name__)
+
+
+class Account(Daikin):
+    """A Daikin with its files in one directory, using a shared Transport"""
+
+    def __init__(self, directory: pathlib.Path, transport: Transport):
+        self.name = directory.name
+        self.app_file = directory / "app.json"
+        self.key_file = directory / "key.json"
+        self.quota_file = directory / "quota.json"
+        self.cache_file = directory / "gateway_devices.json"
+        self._shared = transport
+        # no broker - that only knows about the one key
+        super().__init__(use_broker=False)
+        self.scheduler = PollScheduler(self.quota)
+        self.offset = 0.0  # seconds after the scheduler's time to poll
+
+    def _make_transport(self) -> Transport:
+        return self._shared
+
+    def next_time(self, now: Optional[float] = None) -> float:
+        return self.scheduler.next_time(now) + self.offset
+
+
+class AccountManager:
+    # how often the accounts are spread over - the shortest poll interval
+    spread = 300
+
+    def __init__(
+        self,
+        directory: Optional[pathlib.Path] = None,
+        workers: int = 4,
+        pool_size: int = 8,
+    ):
+        """workers is how many polls can be in progress at once, and
+        pool_size how many connections are kept open to each server"""
+        self.directory = directory or pathlib.Path.home() / ".daikin_accounts"
+        self.workers = workers
+        self.transport = Transport(pool_size=pool_size)
+        self.accounts: Dict[str, Account] = {}
+        self.stop = threading.Event()
+
+    def load(self) -> None:
+        """Set up all the accounts in the directory (skipping any which
+        haven't been authenticated yet)"""
+        for app_file in sorted(self.directory.glob("*/app.json")):
+            name = app_file.parent.name
+            if name in self.accounts:
+                continue
+            try:
+                account = Account(app_file.parent, self.transport)
+            except (OSError, ValueError, KeyError) as e:
+                _logger.error("%s: cannot load account: %s", name, e)
+                continue
+            if not account.key:
+                _logger.error("%s: no key - needs authenticating", name)
+                continue
+            self.accounts[name] = account
+        self._spread()
+
+    def _spread(self) -> None:
+        """Space the accounts evenly within each spread seconds"""
+        for i, account in enumerate(self.accounts.values()):
+            account.offset = i * self.spread / len(self.accounts)
+
+    def _poll(self, account: Account, handle: Callable[[Account, list], None]):
+        try:
+            self._poll_one(account, handle)
+        except Exception:
+            _logger.exception("%s: poll failed", account.name)
+
+    def _poll_one(self, account: Account, handle: Callable[[Account, list], None]):
+        ok, gw = account.scheduler.poll(
+            account.poll, account.device, account.next_time(), account.name
+        )
+        if not ok:
+            return
+        if gw is None:
+            _logger.debug("%s: no change", account.name)
+            return
+        # we only need the digest to spot changes, so don't hang on to
+        # the whole thing for every account
+        account.index = None
+        handle(account, gw)
+
+    def run(self, handle: Callable[[Account, list], None]) -> None:
+        """Poll each account when its scheduler says, until stop is set.
+
+        handle(account, gw) is called with the gateway devices whenever an
+        account's have changed. It's called from the worker threads, so it
+        needs to be safe to call from several at once.
+        """
+        now = time.time()
+        # (when, name) - the first polls are spread out like the rest
+        due = [(now + a.offset, name) for name, a in self.accounts.items()]
+        heapq.heapify(due)
+        busy = set()
+        with ThreadPoolExecutor(self.workers, thread_name_prefix="account") as pool:
+            while due and not self.stop.is_set():
+                when, name = due[0]
+                if self.stop.wait(max(0.0, when - time.time())):
+                    break
+                heapq.heappop(due)
+                account = self.accounts[name]
+                if name not in busy:
+                    busy.add(name)
+                    future = pool.submit(self._poll, account, handle)
+                    future.add_done_callback(lambda f, name=name: busy.discard(name))
+                else:
+                    # still going from last time - just skip this one
+                    _logger.warning("%s: previous poll still running", name)
+                heapq.heappush(due, (account.next_time(), name))
+
+
+def main():
+    logging.basicConfig(format="%(asctime)s %(threadName)s: %(message)s")
+    _logger.setLevel(logging.INFO)
+
+    def show(account, gw):
+        s = SENSORS.extract(gw, account.device)
+        _logger.info("%s: %s", account.name, s)
+
+    manager = AccountManager()
+    manager.load()
+    _logger.info("%d accounts", len(manager.accounts))
+    try:
+        manager.run(show)
+    except KeyboardInterrupt:
+        manager.stop.set()
+
+
+if __name__ == "__main__":
+    main()
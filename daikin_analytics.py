@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+
+"""Analysis of the consumption history with numpy.
+
+daikin_history.py keeps the figures as {period: value} dictionaries,
+which is fine for printing a few of them, but not for looking at years
+of them. Here they're loaded into arrays on a regular time grid (with
+NaN for any gaps), one row per series, so that everything can be done
+on whole arrays at once:
+
+    table = Table.load(History().load()[device], "w")   # daily figures
+    months = table.rollup("M")
+    baseline = table.rolling(28)
+    heating, dhw = table.split()
+
+The outdoor temperatures from the sample store (see daikin_store.py) give
+the heating degree days for each day, so the heating can be compared
+between cold and mild spells:
+
+    hdd = degree_days(Store(), table.times)
+    fit = DegreeDayFit.fit(hdd, heating)
+    fit.normalise(heating, hdd, reference=10)
+
+Needs numpy. Run as a script, it prints a summary for each device.
+"""
+
+import datetime
+import time
+
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from daikin_history import History
+from daikin_store import NUMPY_DTYPE, Store
+
+# the numpy time units, and the step, for each of the d/w/m series
+# (the "w" series holds daily figures - see daikin_history.py)
+GRID = {"d": ("h", 2), "w": ("D", 1), "m": ("M", 1)}
+
+HEATING = "climateControlMainZone/heating"
+DHW = "domesticHotWaterTank/heating"
+
+
+class Table:
+    """Several series of the same resolution, on a common time axis.
+
+    times is an array of numpy datetime64 (in local time, as the keys are),
+    and values has one row per name, with NaN where there's no figure.
+    step is how many of the time units each figure covers.
+    """
+
+    def __init__(
+        self, names: List[str], times: np.ndarray, values: np.ndarray, step: int = 1
+    ):
+        self.names = names
+        self.times = times
+        self.values = values
+        self.step = step
+
+    @classmethod
+    def load(cls, device_history: dict, want: str) -> "Table":
+        """Build from one device's part of History.load()"""
+        unit, step = GRID[want]
+        names = sorted(n for n, s in device_history.items() if s.get(want))
+        if not names:
+            return cls([], np.array([], dtype=f"datetime64[{unit}]"), np.zeros((0, 0)))
+
+        parsed = []
+        for name in names:
+            series = device_history[name][want]
+            keys = np.array(list(series), dtype=f"datetime64[{unit}]")
+            parsed.append((keys, np.fromiter(series.values(), float, len(series))))
+
+        start = min(k.min() for k, _ in parsed)
+        end = max(k.max() for k, _ in parsed)
+        times = np.arange(start, end + step, step)
+        values = np.full((len(names), len(times)), np.nan)
+        for row, (keys, v) in enumerate(parsed):
+            values[row, (keys - start).astype(int) // step] = v
+        return cls(names, times, values, step)
+
+    def row(self, name: str) -> np.ndarray:
+        """One series, or all NaN if there isn't one of that name"""
+        if name in self.names:
+            return self.values[self.names.index(name)]
+        return np.full(len(self.times), np.nan)
+
+    def rollup(self, unit: str, complete: bool = True) -> "Table":
+        """Add up the figures into coarser periods - unit is a numpy time unit,
+        eg "D", "W", "M" or "Y". With complete, a period with any figures
+        missing is NaN, rather than a total of the ones that are there.
+
+        (numpy weeks start on Thursdays, as 1970-01-01 was one. Use
+        weekly() for Monday-based weeks like the api's.)
+        """
+        periods = self.times.astype(f"datetime64[{unit}]")
+        return self._group(periods, periods + 1, complete)
+
+    def weekly(self, complete: bool = True) -> "Table":
+        """Like rollup("W") but with the weeks starting on Mondays"""
+        days = self.times.astype("datetime64[D]")
+        # 1970-01-05 was a Monday
+        monday = np.datetime64("1970-01-05")
+        periods = monday + ((days - monday) // 7) * 7
+        return self._group(periods, periods + 7, complete)
+
+    def _group(self, periods: np.ndarray, ends: np.ndarray, complete: bool) -> "Table":
+        """Add up the figures in each of the periods - ends being when each
+        of those finishes, so we know how many figures a whole one has"""
+        keys, first, inverse = np.unique(
+            periods, return_index=True, return_inverse=True
+        )
+        present = ~np.isnan(self.values)
+        totals = np.zeros((len(self.names), len(keys)))
+        counts = np.zeros((len(self.names), len(keys)))
+        # a period at either end of the data may only be partly in the table,
+        # so go by the calendar, not by how many times there are
+        unit = self.times.dtype
+        size = (ends[first].astype(unit) - keys.astype(unit)).astype(int) // self.step
+        # np.add.at does all the rows at once, unbuffered
+        cols = np.broadcast_to(inverse, self.values.shape)
+        rows = np.broadcast_to(np.arange(len(self.names))[:, None], self.values.shape)
+        np.add.at(totals, (rows, cols), np.where(present, self.values, 0))
+        np.add.at(counts, (rows, cols), present)
+        missing = counts < size if complete else counts == 0
+        return Table(self.names, keys, np.where(missing, np.nan, totals))
+
+    def rolling(self, window: int) -> np.ndarray:
+        """The mean over the last window periods (ignoring gaps), for each
+        series - eg a baseline to compare each day with"""
+        present = ~np.isnan(self.values)
+        sums = np.cumsum(np.where(present, self.values, 0), axis=1)
+        counts = np.cumsum(present, axis=1)
+        pad = np.zeros((len(self.names), 1))
+        sums = np.hstack([pad, sums])
+        counts = np.hstack([pad, counts])
+        lo = np.maximum(np.arange(1, len(self.times) + 1) - window, 0)
+        hi = np.arange(1, len(self.times) + 1)
+        n = counts[:, hi] - counts[:, lo]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(n > 0, (sums[:, hi] - sums[:, lo]) / n, np.nan)
+
+    def split(self) -> Tuple[np.ndarray, np.ndarray]:
+        """The space heating and hot water figures"""
+        return self.row(HEATING), self.row(DHW)
+
+    def heating_share(self) -> np.ndarray:
+        """The fraction of the total which went on space heating"""
+        heating, dhw = self.split()
+        total = heating + dhw
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(total > 0, heating / total, np.nan)
+
+
+def _local(t: np.ndarray) -> np.ndarray:
+    """Convert seconds since the epoch to local datetime64[s], allowing
+    for daylight saving. The offset is only looked up once per hour."""
+    hours, inverse = np.unique(t // 3600, return_inverse=True)
+    offsets = np.array([time.localtime(int(h) * 3600).tm_gmtoff for h in hours])
+    return (t + offsets[inverse]).astype("datetime64[s]")
+
+
+def degree_days(
+    store: Store,
+    days: np.ndarray,
+    base: float = 15.5,
+    max_gap: float = 7200,
+    min_cover: float = 0.5,
+) -> np.ndarray:
+    """The heating degree days for each of the given days (datetime64[D]),
+    from the outdoor temperatures in the sample store.
+
+    Each sample is taken to hold until the next one (the monitors skip
+    polls where nothing changed), but for no more than max_gap seconds.
+    A day with less than min_cover of it sampled is NaN.
+    """
+    days = days.astype("datetime64[D]")
+    if not len(days):
+        return np.zeros(0)
+    start = time.mktime(days[0].astype(datetime.date).timetuple()) - 86400
+    end = time.mktime(days[-1].astype(datetime.date).timetuple()) + 2 * 86400
+    s = np.frombuffer(store.read_bytes(start, end), dtype=NUMPY_DTYPE)
+    s = s[~np.isnan(s["outdoor"])]
+    s = s[np.argsort(s["time"], kind="stable")]
+    t = s["time"].astype(np.int64)
+    outdoor = s["outdoor"].astype(float)
+
+    held = np.minimum(np.diff(t, append=t[-1:]), max_gap)
+    deficit = np.clip(base - outdoor, 0, None)
+    span = int((days[-1] - days[0]).astype(int)) + 1
+    index = (_local(t).astype("datetime64[D]") - days[0]).astype(int)
+    ok = (index >= 0) & (index < span)
+    weighted = np.bincount(index[ok], weights=(deficit * held)[ok], minlength=span)
+    covered = np.bincount(index[ok], weights=held[ok], minlength=span)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        hdd = np.where(covered >= min_cover * 86400, weighted / covered, np.nan)
+    return hdd[(days - days[0]).astype(int)]
+
+
+class DegreeDayFit:
+    """consumption = base + per_degree_day * hdd, fitted by least squares"""
+
+    def __init__(self, base: float, per_degree_day: float, days: int):
+        self.base = base
+        self.per_degree_day = per_degree_day
+        self.days = days  # how many it was fitted to
+
+    @classmethod
+    def fit(cls, hdd: np.ndarray, consumption: np.ndarray) -> Optional["DegreeDayFit"]:
+        ok = ~np.isnan(hdd) & ~np.isnan(consumption)
+        if ok.sum() < 2 or np.ptp(hdd[ok]) == 0:
+            return None
+        slope, intercept = np.polyfit(hdd[ok], consumption[ok], 1)
+        return cls(intercept, slope, int(ok.sum()))
+
+    def normalise(
+        self, consumption: np.ndarray, hdd: np.ndarray, reference: float
+    ) -> np.ndarray:
+        """What the consumption would have been with reference degree days"""
+        return consumption + self.per_degree_day * (reference - hdd)
+
+    def __repr__(self):
+        return (
+            f"{self.base:.1f} kWh + {self.per_degree_day:.2f} kWh per degree day"
+            f" ({self.days} days)"
+        )
+
+
+def main():
+    data = History().load()
+    store = Store()
+    for device, device_history in data.items():
+        print(device)
+        daily = Table.load(device_history, "w")
+        if not len(daily.times):
+            continue
+
+        monthly = daily.rollup("M")
+        heating, dhw = monthly.split()
+        print("  month     heating  hot water  heating share")
+        for m, h, w, f in zip(monthly.times, heating, dhw, monthly.heating_share()):
+            print(f"  {m}  {h:8.0f}  {w:9.0f}  {100 * f:12.0f}%")
+
+        hdd = degree_days(store, daily.times)
+        fit = DegreeDayFit.fit(hdd, daily.row(HEATING))
+        print("  heating:", fit or "not enough days with temperatures to fit")
+
+
+if __name__ == "__main__":
+    main()
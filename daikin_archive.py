@@ -0,0 +1,270 @@
+"""An archive of the raw gateway-devices results, for debugging and replay.
+
+Consecutive polls are almost identical - only a handful of sensor values
+move in 10 minutes - so rather than keeping every response, the state is
+flattened into {path: value}, where the path is like
+
+    <device id>/climateControlMainZone/sensoryData/value/outdoorTemperature/value
+
+and only the paths which changed are written. Each monthly file
+(eg 202410.arc, next to the sample store) is json lines, starting with a
+full snapshot (a "keyframe"), followed by deltas:
+
+    {"t": 1729853623, "paths": [...], "values": [...]}
+    {"t": 1729854223, "set": [[17, 21.5], [40, 6]], "new": [...], "del": [3]}
+
+The paths are numbered in the order they appear in the keyframe (and any
+"new" ones are added on the end), so a delta is only a few dozen bytes.
+A new keyframe is written every keyframe_every records, so reconstructing
+the state at any time only has to apply a limited number of deltas.
+
+Polls where nothing changed aren't written at all. digest() gives a hash
+of a flattened state, which is what Daikin.poll() uses to spot those.
+"""
+
+import bisect
+import hashlib
+import json
+import os
+import pathlib
+import time
+
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from daikin_lock import locked_file
+
+# these change on every poll, even when nothing else has
+VOLATILE = ("lastUpdateReceived",)
+
+
+def flatten(gw: list) -> Dict[str, Any]:
+    """Flatten a gateway-devices result into {path: value}.
+
+    Management points go under their embeddedId, anything else at the
+    top level of a gateway device under "@" + its name. Lists are kept
+    whole, as values.
+    """
+    state = {}
+
+    def walk(node, path):
+        if isinstance(node, dict):
+            for k, v in node.items():
+                if k not in VOLATILE:
+                    walk(v, path + "/" + k)
+        else:
+            state[path] = node
+
+    for g in gw:
+        for k, v in g.items():
+            if k == "managementPoints":
+                for mp in v:
+                    walk(mp, g["id"] + "/" + mp["embeddedId"])
+            elif k not in VOLATILE:
+                walk(v, g["id"] + "/@" + k)
+    return state
+
+
+def digest(state: Dict[str, Any]) -> str:
+    """A hash of a flattened state, to tell whether anything has changed"""
+    text = json.dumps(state, sort_keys=True, separators=(",", ":"))
+    return hashlib.blake2b(text.encode(), digest_size=16).hexdigest()
+
+
+def management_points(state: Dict[str, Any], device: str) -> dict:
+    """Rebuild the management points dictionary for a device from a flattened
+    state, in the same form as Daikin.management_points() returns
+    """
+    mp: dict = {}
+    prefix = device + "/"
+    for path, value in state.items():
+        if not path.startswith(prefix) or path[len(prefix)] == "@":
+            continue
+        keys = path[len(prefix) :].split("/")
+        node = mp
+        for k in keys[:-1]:
+            node = node.setdefault(k, {})
+        node[keys[-1]] = value
+    return mp
+
+
+def _apply(rec: dict, table: List[str], state: Dict[str, Any]) -> List[str]:
+    """Apply a record to a path table and state, in place, unless it's
+    a keyframe, which replaces them. Returns the table."""
+    if "paths" in rec:
+        table = list(rec["paths"])
+        state.clear()
+        state.update(zip(table, rec["values"]))
+        return table
+    table.extend(rec.get("new", ()))
+    for n in rec.get("del", ()):
+        state.pop(table[n], None)
+    for n, v in rec.get("set", ()):
+        state[table[n]] = v
+    return table
+
+
+class _Segment:
+    """The records from one archive file, decoded, with the keyframe positions"""
+
+    def __init__(self, path: pathlib.Path):
+        self.records = []
+        with path.open("rb") as f:
+            for line in f:
+                try:
+                    self.records.append(json.loads(line))
+                except ValueError:
+                    break  # partial line at the end, after a crash
+        # a file has to start with a keyframe to be any use
+        if self.records and "paths" not in self.records[0]:
+            self.records = []
+        self.times = [r["t"] for r in self.records]
+        self.keyframes = [i for i, r in enumerate(self.records) if "paths" in r]
+
+    def replay(self, start: int, end: int) -> Iterator[Tuple[float, Dict[str, Any]]]:
+        """Apply records start..end-1, from the keyframe at or before start,
+        yielding (time, state) after each one from start. It's the same
+        dictionary each time, updated.
+        """
+        k = self.keyframes[bisect.bisect_right(self.keyframes, start) - 1]
+        table: List[str] = []
+        state: Dict[str, Any] = {}
+        for i in range(k, end):
+            table = _apply(self.records[i], table, state)
+            if i >= start:
+                yield self.records[i]["t"], state
+
+
+def _trim(fd: int) -> int:
+    """Cut off any partial line left at the end of a file by a crash,
+    and return the size of what's left"""
+    size = os.fstat(fd).st_size
+    if size and os.pread(fd, 1, size - 1) != b"\n":
+        tail = os.pread(fd, min(size, 1 << 20), max(0, size - (1 << 20)))
+        size -= len(tail) - (tail.rfind(b"\n") + 1)
+        os.ftruncate(fd, size)
+    return size
+
+
+class Archive:
+    # write a full snapshot after this many deltas (a week, at 10 minutes)
+    keyframe_every = 1008
+
+    def __init__(self, directory: Optional[pathlib.Path] = None):
+        self.directory = directory or pathlib.Path.home() / ".daikin_store"
+        self.directory.mkdir(parents=True, exist_ok=True)
+        # what's at the end of the file we're writing to, as far as we know
+        self._file: Optional[pathlib.Path] = None
+        self._size = 0
+        self._table: List[str] = []
+        self._index: Dict[str, int] = {}
+        self._state: Dict[str, Any] = {}
+        self._since_keyframe = 0
+
+    def _path(self, t: float) -> pathlib.Path:
+        return self.directory / (time.strftime("%Y%m", time.localtime(t)) + ".arc")
+
+    def segments(self) -> List[pathlib.Path]:
+        return sorted(self.directory.glob("*.arc"))
+
+    def _catch_up(self, path: pathlib.Path, size: int) -> None:
+        """Bring our idea of the state at the end of the file up to date,
+        if it's not what we last wrote (eg because another process has been
+        writing to it too, or we've only just started). Only the new part
+        of the file needs reading.
+        """
+        if path != self._file or size < self._size:
+            self._file, self._size = path, 0
+            self._table, self._state = [], {}
+            self._since_keyframe = 0
+        if size == self._size:
+            return
+        with path.open("rb") as f:
+            f.seek(self._size)
+            for line in f.read(size - self._size).splitlines():
+                rec = json.loads(line)
+                self._table = _apply(rec, self._table, self._state)
+                if "paths" in rec:
+                    self._since_keyframe = 0
+                else:
+                    self._since_keyframe += 1
+        self._size = size
+        self._index = {p: i for i, p in enumerate(self._table)}
+
+    def record(self, t: float, gw: list) -> Dict[str, Any]:
+        """Add a gateway-devices result to the archive.
+
+        Returns the paths which changed, with their new values (deleted
+        paths have None). Nothing is written if that's empty.
+        """
+        state = flatten(gw)
+        path = self._path(t)
+        with locked_file(path) as f:
+            size = _trim(f.fileno())
+            self._catch_up(path, size)
+
+            changed = {p: v for p, v in state.items() if self._state.get(p, self) != v}
+            gone = [p for p in self._state if p not in state]
+            if not changed and not gone:
+                return {}
+
+            if not self._table or self._since_keyframe >= self.keyframe_every:
+                self._table = list(state)
+                self._index = {p: i for i, p in enumerate(self._table)}
+                rec = {"t": t, "paths": self._table, "values": list(state.values())}
+                self._since_keyframe = 0
+            else:
+                new = [p for p in changed if p not in self._index]
+                for p in new:
+                    self._index[p] = len(self._table)
+                    self._table.append(p)
+                rec = {"t": t, "set": [[self._index[p], v] for p, v in changed.items()]}
+                if new:
+                    rec["new"] = new
+                if gone:
+                    rec["del"] = [self._index[p] for p in gone]
+                self._since_keyframe += 1
+
+            line = json.dumps(rec, separators=(",", ":")) + "\n"
+            f.seek(0, os.SEEK_END)
+            f.write(line)
+            f.flush()
+            self._size = size + len(line.encode())
+            self._state = state
+
+        changed.update((p, None) for p in gone)
+        return changed
+
+    def _segment_before(self, t: float) -> Optional[Tuple[_Segment, int]]:
+        """The segment, and the number of its records, up to and including time t"""
+        for path in reversed(self.segments()):
+            seg = _Segment(path)
+            n = bisect.bisect_right(seg.times, t)
+            if n:
+                return seg, n
+        return None
+
+    def state_at(self, t: float) -> Dict[str, Any]:
+        """The flattened state as it was at time t (empty if the archive
+        doesn't go back that far)"""
+        found = self._segment_before(t)
+        if found is None:
+            return {}
+        seg, n = found
+        for _, state in seg.replay(n - 1, n):
+            return dict(state)
+
+    def replay(
+        self, start: float, end: Optional[float] = None
+    ) -> Iterator[Tuple[float, Dict[str, Any]]]:
+        """Yield (time, state) for each change recorded from start to end.
+
+        The state is a new dictionary each time, so it can be kept.
+        """
+        end = end or time.time()
+        for path in self.segments():
+            seg = _Segment(path)
+            first = bisect.bisect_left(seg.times, start)
+            last = bisect.bisect_right(seg.times, end)
+            if first < last:
+                for t, state in seg.replay(first, last):
+                    yield t, dict(state)
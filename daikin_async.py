@@ -0,0 +1,325 @@
+"""An asyncio version of the Daikin class.
+
+Same idea as Daikin, but using aiohttp, so it can sit inside an
+asyncio program and run alongside other requests (eg to myenergi)
+rather than one after the other.
+
+It uses the same app and key files, with the same locking, so it can
+share the credentials with the ordinary (synchronous) scripts. Within
+a process, only one task will ever refresh the key - any others that
+find it has expired just wait for that one to finish.
+
+Needs aiohttp from pip, in addition to the requirements of daikin.py
+
+    async with AsyncDaikin() as daikin:
+        mp = await daikin.management_points()
+"""
+
+import asyncio
+import fcntl
+import json
+import logging
+import time
+
+from typing import AsyncIterator, Iterable, List, Optional
+
+import aiohttp
+
+from daikin import Daikin, DeviceIndex, _complete, _endpoint
+from daikin_archive import digest, flatten
+from daikin_fields import SENSORS, FieldSpec, Snapshot
+from daikin_metrics import emit
+from daikin_quota import QuotaExceeded
+from daikin_schedule import PollScheduler
+from daikin_watch import ChangeEvent, Subscription, changes
+
+_logger = logging.getLogger(__name__)
+
+
+class AsyncDaikin(Daikin):
+    """Daikin Cloud API access using asyncio.
+
+    The configuration and key handling are inherited from Daikin,
+    but the methods which do any I/O are coroutines. Every Daikin method
+    which makes requests has to be overridden here (the inherited one would
+    be using the requests Transport, which this hasn't got) - so anything
+    added to Daikin needs adding here too.
+    """
+
+    # maximum number of simultaneous connections to the api
+    pool_size = 4
+
+    session: aiohttp.ClientSession
+
+    def __init__(self, cache_ttl: float = 0):
+        super().__init__(cache_ttl)
+        self.session = None
+        self._refresh_lock = asyncio.Lock()
+        self._cache_lock = asyncio.Lock()
+
+    def _make_transport(self):
+        # aiohttp wants the session to be created from within the event loop,
+        # so it's done on first use - see _get_session()
+        return None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size),
+                timeout=aiohttp.ClientTimeout(total=30),
+            )
+        return self.session
+
+    async def warm_up(self) -> None:
+        """Open the connection to the api in advance - see Daikin.warm_up()"""
+        try:
+            async with self._get_session().head(self.api_url):
+                pass
+        except aiohttp.ClientError as e:
+            _logger.debug("warm up of %s failed: %s", self.api_url, e)
+
+    async def close(self) -> None:
+        if self.session is not None:
+            await self.session.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def _get_or_refresh_key(self, code=None) -> str:
+        """Generate or refresh access token - see Daikin._get_or_refresh_key()"""
+        session = self._get_session()
+        async with session.post(
+            self.idp_url + "/token", params=self._token_args(code)
+        ) as r:
+            r.raise_for_status()
+            return await r.text()
+
+    async def get_new_key(self, code: str) -> None:
+        j = await self._get_or_refresh_key(code)
+        with self.key_file.open(mode="w") as kf:
+            self._store_key(kf, j)
+
+    async def check_key_expiry(self) -> None:
+        """Check whether key has expired, and try to update if necessary.
+
+        If several tasks call this at once, only the first does the refresh
+        and the others wait for it.
+        """
+
+        if not self._key_expired():
+            return
+
+        async with self._refresh_lock:
+            if not self._key_expired():
+                # another task got there first
+                return
+
+            if self.broker:
+                if await asyncio.to_thread(self._key_from_broker):
+                    return
+                if not self._key_expired():
+                    return
+
+            with self.key_file.open(mode="r+") as kf:
+                # flock() might block for a while if another process is
+                # refreshing, so do that in a thread
+                start = time.perf_counter()
+                await asyncio.to_thread(fcntl.flock, kf.fileno(), fcntl.LOCK_EX)
+                emit("lock", name="key", seconds=time.perf_counter() - start)
+
+                if self._reload_if_newer(kf):
+                    return
+
+                _logger.info("need to refresh key")
+                try:
+                    j = await self._get_or_refresh_key()
+                except Exception:
+                    emit("refresh", ok=False)
+                    raise
+                emit("refresh", ok=True)
+                self._store_key(kf, j)
+                # the lock is released when the file is closed
+
+    async def _request(self, method: str, url: str, write: bool, **kwargs):
+        await self.check_key_expiry()
+        # the quota ledger is locked, and might decide to sleep, so
+        # keep it off the event loop
+        emit("quota", remaining=await asyncio.to_thread(self.quota.acquire, write))
+        headers = {"Authorization": "Bearer " + self.key["access_token"]}
+        session = self._get_session()
+        start = time.perf_counter()
+        async with session.request(method, url, headers=headers, **kwargs) as r:
+            body = await r.read()
+            emit(
+                "request",
+                method=method,
+                endpoint=_endpoint(url),
+                status=r.status,
+                seconds=time.perf_counter() - start,
+                bytes=len(body),
+                retries=0,
+            )
+            remaining = await asyncio.to_thread(self.quota.update, r.status, r.headers)
+            if remaining is not None:
+                emit("quota", remaining=remaining)
+            r.raise_for_status()
+            return body
+
+    async def get(self, command: str):
+        """Perform a get on an api leaf. Return the output as a dictionary."""
+        return json.loads(await self.get_raw(command))
+
+    async def get_many(
+        self, commands: List[str], max_workers: Optional[int] = None
+    ) -> list:
+        """get() each of the commands, several at a time - see Daikin.get_many()"""
+        limit = asyncio.Semaphore(min(max_workers or self.pool_size, self.pool_size))
+
+        async def one(command):
+            async with limit:
+                return await self.get(command)
+
+        return await asyncio.gather(*(one(c) for c in commands))
+
+    async def get_raw(self, command: str) -> bytes:
+        """Perform a get on an api leaf, and return the raw response body"""
+        return await self._request("GET", self.api_url + "/" + command, False)
+
+    async def patch(self, name: str, device: Optional[str] = None, **payload) -> None:
+        """Perform a patch on a management id - see Daikin.patch()"""
+        device = device or self.device
+        if device is None:
+            raise ValueError("need to configure device")
+        url = f"{self.api_url}/gateway-devices/{device}/management-points/{name}"
+        await self._request("PATCH", url, True, json=payload)
+
+    async def gateway_devices(self) -> list:
+        """Get the list of gateway devices, from the cache if it's enabled"""
+        if self.cache is None:
+            return await self.get("gateway-devices")
+
+        # The cache does its locking and waiting synchronously, so run it
+        # in a thread, and have it hand the actual fetch back to the loop.
+        # Only let one task at a time in there: the others would just be
+        # tying up threads waiting for the same file lock (which can starve
+        # the fetch of the thread it needs).
+        loop = asyncio.get_running_loop()
+
+        def fetch():
+            return asyncio.run_coroutine_threadsafe(
+                self.get("gateway-devices"), loop
+            ).result()
+
+        async with self._cache_lock:
+            return await asyncio.to_thread(self.cache.get, fetch, _complete)
+
+    async def devices(self) -> DeviceIndex:
+        """Fetch gateway-devices and index all the devices - see Daikin.devices()"""
+        return self._make_index(await self.gateway_devices(), time.time())
+
+    async def gateway_device(self, device: Optional[str] = None) -> dict:
+        """Get one gateway device on its own - see Daikin.gateway_device()"""
+        device = device or self.device
+        if device is None:
+            raise ValueError("need to configure device")
+        g = await self.get(self.endpoints["device"].format(device=device))
+        self._merge_device(g, time.time())
+        return g
+
+    async def poll(self) -> Optional[list]:
+        """Fetch gateway-devices, but return None if nothing has changed
+        since the last time - see Daikin.poll()"""
+        gw = await self.gateway_devices()
+        d = digest(flatten(gw))
+        if d == self.last_digest:
+            return None
+        self.last_digest = d
+        self._make_index(gw, time.time())
+        return gw
+
+    async def watch(
+        self, paths: Iterable[str], device: Optional[str] = None
+    ) -> AsyncIterator[ChangeEvent]:
+        """Poll for ever, yielding a ChangeEvent whenever one of the values
+        under paths changes - see Daikin.watch()
+
+            async for event in daikin.watch(paths):
+
+        Unlike the synchronous one, each watch does its own polling (as often
+        as a PollScheduler says), so if you want several, it's cheaper to
+        watch all the paths at once and sort the events out yourself.
+        """
+        sub = Subscription(paths, device)
+        scheduler = PollScheduler(self.quota)
+        state = {}
+        while True:
+            try:
+                # give up if it's not done by the time of the next poll
+                gw = await asyncio.wait_for(
+                    self.gateway_devices(),
+                    max(1.0, scheduler.next_time() - time.time()),
+                )
+            except (QuotaExceeded, aiohttp.ClientError, asyncio.TimeoutError) as e:
+                _logger.warning("%s", str(e) or "watch poll timed out")
+            else:
+                now = time.time()
+                self._make_index(gw, now)
+                scheduler.observe(now, SENSORS.extract(gw, self.device).as_dict())
+                new = flatten(gw)
+                sub.offer(self.device, changes(state, new), now)
+                state = new
+                while not sub.queue.empty():
+                    yield sub.queue.get_nowait()
+            await asyncio.sleep(max(0.0, scheduler.next_time() - time.time()))
+
+    async def management_points(self, device: Optional[str] = None) -> dict:
+        """Return the management points from a gateway device,
+        keyed by embeddedId - see Daikin.management_points()
+        """
+        device = device or self.device
+        if self.endpoint(device) == self.endpoints["all"]:
+            index = await self.devices()
+            return index.management_points(device)
+        g = await self.gateway_device(device)
+        return DeviceIndex([g]).management_points(device)
+
+    async def read_fields(
+        self, spec: FieldSpec, device: Optional[str] = None
+    ) -> Snapshot:
+        """Fetch the device and extract just the fields in spec -
+        see Daikin.read_fields()
+        """
+        device = device or self.device
+        if self.cache is None:
+            gw = spec.parse(await self.get_raw(self.endpoint(device)))
+            return spec.extract(gw if isinstance(gw, list) else [gw], device)
+        return spec.extract(await self.gateway_devices(), device)
+
+    async def read_all_fields(self, spec: FieldSpec) -> dict:
+        """Like read_fields(), but for every gateway device - see
+        Daikin.read_all_fields()"""
+        if self.cache is None:
+            gw = spec.parse(await self.get_raw("gateway-devices"))
+        else:
+            gw = await self.gateway_devices()
+        return {g["id"]: spec.extract([g]) for g in gw}
+
+    async def set_temperature_control(self, name, value, device: Optional[str] = None):
+        """Patch a temperature control = either "roomTemperature" or "leavingWaterOffset" """
+        await self.patch(
+            "climateControlMainZone/characteristics/temperatureControl",
+            device,
+            path="/operationModes/heating/setpoints/" + name,
+            value=value,
+        )
+
+    async def set_powerful_mode(self, state, device: Optional[str] = None):
+        """Turn water immersion heater on or off"""
+        await self.patch(
+            "domesticHotWaterTank/characteristics/powerfulMode",
+            device,
+            value="on" if state else "off",
+        )
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+
+"""A little daemon which looks after the access token for everyone.
+
+Rather than every script reading the key file and possibly racing to
+refresh it, this can be left running, and it is then the only thing
+that ever uses the refresh token. It refreshes the key in the background
+a few minutes before it expires, and hands out the current access
+token to anyone who asks on a unix socket (next to the key file).
+
+The Daikin class checks for the socket when it starts, and if there is
+a broker there, it uses that instead of the files. If the broker goes
+away, it falls back to doing it the old way. The broker still writes
+the key file, so that keeps working.
+
+The protocol is one line of json each way, eg
+    {"op": "token"}
+    {"access_token": "...", "expires_at": 1729853623.2, "device": "..."}
+
+It will also run commands for daikin-cli.py, using its own Daikin with
+the connection to the api already open, and the key and gateway-devices
+to hand, which is a lot quicker than starting python and importing
+requests and everything for each one:
+    {"op": "cli", "script": "daikin", "argv": ["sensors"]}
+    {"output": "outdoor=12, room=20.5 / 21, hw=47, lwt=32\n"}
+
+This module deliberately only imports standard modules at the top, so
+that ask() (and connect() and send()) are cheap to use.
+"""
+
+import importlib
+import io
+import json
+import logging
+import os
+import pathlib
+import socket
+import socketserver
+import sys
+import threading
+import time
+
+from typing import Callable, Dict, Optional
+
+_logger = logging.getLogger(__name__)
+
+
+class BrokerError(Exception):
+    """Something went wrong after a request was sent to the broker - so it
+    may or may not have been carried out"""
+
+
+def connect(path: pathlib.Path, timeout: float = 5) -> Optional[socket.socket]:
+    """Connect to the broker, or return None if there isn't one running"""
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.settimeout(timeout)
+        s.connect(str(path))
+        return s
+    except OSError:
+        s.close()
+        return None
+
+
+def send(s: socket.socket, request: dict) -> dict:
+    """Send a request on a connection from connect(), and return the reply.
+
+    Raises BrokerError if there's no reply (eg it times out).
+    """
+    with s:
+        try:
+            s.sendall(json.dumps(request).encode() + b"\n")
+            with s.makefile("rb") as f:
+                return json.loads(f.readline())
+        except (OSError, ValueError) as e:
+            raise BrokerError(f"no reply from the broker: {e or type(e).__name__}")
+
+
+def ask(path: pathlib.Path, request: dict, timeout: float = 5) -> Optional[dict]:
+    """Send a request to the broker and return the reply.
+
+    Returns None if there's no broker running (or it's not answering).
+    Only for requests which are fine to repeat if that happens - see
+    connect() and send() for the others.
+    """
+    s = connect(path, timeout)
+    if s is None:
+        return None
+    try:
+        return send(s, request)
+    except BrokerError:
+        return None
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+            op = self.server.ops[request["op"]]
+            reply = op(request)
+        except Exception as e:
+            _logger.warning("bad request: %s", e)
+            reply = {"error": str(e)}
+        self.wfile.write(json.dumps(reply).encode() + b"\n")
+
+
+class Broker(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """The server. daikin is a Daikin instance which must not itself be
+    using a broker.
+    """
+
+    daemon_threads = True
+
+    # refresh the key this many seconds before it expires
+    ahead = 300
+
+    def __init__(self, daikin, path: pathlib.Path):
+        self.daikin = daikin
+        self.path = path
+        self.lock = threading.Lock()  # around anything touching the key
+        self.cli_lock = threading.Lock()  # one command at a time
+        self.ops: Dict[str, Callable[[dict], dict]] = {
+            "token": self.token,
+            "cli": self.cli,
+        }
+
+        if ask(path, {"op": "token"}) is not None:
+            raise RuntimeError(f"there's already a broker running on {path}")
+        path.unlink(missing_ok=True)  # left over from last time
+
+        old = os.umask(0o077)  # only for us
+        try:
+            super().__init__(str(path), _Handler)
+        finally:
+            os.umask(old)
+
+    def token(self, request: dict) -> dict:
+        with self.lock:
+            # should have been done by the refresher, but just in case
+            self.daikin.check_key_expiry(margin=60)
+            return {
+                "access_token": self.daikin.key["access_token"],
+                "expires_at": self.daikin.key_expiry,
+                "device": self.daikin.device,
+            }
+
+    def cli(self, request: dict) -> dict:
+        """Run a command from daikin.py (or daikin-consumption.py, if script
+        is "consumption") and send back whatever it printed"""
+        if request.get("script", "daikin") == "consumption":
+            run = importlib.import_module("daikin-consumption").run
+        else:
+            from daikin import run
+        out = io.StringIO()
+        try:
+            # commands can take a while, so they have their own lock rather
+            # than holding up anyone wanting a token
+            with self.cli_lock:
+                run(self.daikin, request["argv"], out)
+        except Exception as e:
+            _logger.warning("command %s failed: %s", request["argv"], e)
+            return {"output": out.getvalue(), "error": str(e)}
+        return {"output": out.getvalue()}
+
+    def refresher(self) -> None:
+        """Keep the key fresh, ahead of it expiring. Runs in its own thread."""
+        while True:
+            try:
+                with self.lock:
+                    self.daikin.check_key_expiry(margin=self.ahead)
+                wait = self.daikin.key_expiry - self.ahead - time.time()
+            except Exception as e:
+                _logger.error("failed to refresh key: %s", e)
+                wait = 60
+            time.sleep(max(10, wait))
+
+    def run(self) -> None:
+        threading.Thread(target=self.refresher, daemon=True).start()
+        try:
+            self.serve_forever()
+        finally:
+            self.path.unlink(missing_ok=True)
+
+
+def main():
+    from daikin import Daikin
+
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+    # with a short-lived cache, so that commands from daikin-cli.py can
+    # share a recent gateway-devices with each other and the monitors
+    daikin = Daikin(cache_ttl=60, use_broker=False)
+    daikin.warm_up()
+    broker = Broker(daikin, daikin.broker_socket)
+    _logger.info("broker listening on %s", daikin.broker_socket)
+    try:
+        broker.run()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""A cache for api responses, shared between processes.
+
+If a couple of monitors and a cron job all want gateway-devices within
+a few minutes of each other, there's no point paying for it three times
+out of the 200 per day. So the response gets stashed in a file in /tmp,
+and anyone wanting it within the ttl gets that copy instead.
+
+The data file is always replaced atomically (write a temp file then
+rename), so it can be read without any locking. A separate lock file,
+locked in the same way as the key file, is held by whichever process
+is fetching a new copy, so that the others can wait for that rather
+than all doing their own fetch. Or, if they have a not-too-old copy,
+they can just use that and not wait (stale-while-revalidate).
+
+The api sometimes returns empty or partial results. The caller can
+supply a check for that, in which case the last good copy is returned
+instead of the bad one - but only for as long as a stale copy would be
+used, after which the new one is taken to be the way things are now.
+"""
+
+import fcntl
+import json
+import logging
+import os
+import pathlib
+import time
+
+from typing import Any, Callable, Optional
+
+_logger = logging.getLogger(__name__)
+
+
+class ResponseCache:
+    """A single cached api response, stored as json in a file."""
+
+    def __init__(self, path: pathlib.Path, ttl: float, stale_ttl: float = 3600):
+        """ttl is how long (seconds) a copy counts as fresh.
+
+        stale_ttl is how much longer a copy can be used in place of
+        a fresh one if we can't (or don't want to wait to) fetch a
+        new one.
+        """
+        self.path = path
+        self.lock_path = path.with_name(path.name + ".lock")
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+
+    def load(self) -> Optional[dict]:
+        """Return the cached {"stamp":..., "data":...}, or None"""
+        try:
+            with self.path.open() as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def save(self, data: Any) -> None:
+        tmp = self.path.with_name(f"{self.path.name}.{os.getpid()}")
+        with tmp.open("w") as f:
+            json.dump({"stamp": time.time(), "data": data}, f)
+        os.replace(tmp, self.path)
+
+    def _age(self, snap: Optional[dict]) -> float:
+        return time.time() - snap["stamp"] if snap else float("inf")
+
+    def get(
+        self,
+        fetch: Callable[[], Any],
+        valid: Optional[Callable[[Any, Any], bool]] = None,
+    ) -> Any:
+        """Return the cached data, or call fetch() to get a new copy.
+
+        valid(new, old) can check a freshly-fetched result against the
+        last good one (old will be None if there isn't one). If it returns
+        False, the new result is discarded and the old one is returned.
+        """
+
+        snap = self.load()
+        if self._age(snap) < self.ttl:
+            return snap["data"]
+
+        fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # someone else is already fetching it
+                if self._age(snap) < self.ttl + self.stale_ttl:
+                    _logger.debug("fetch in progress elsewhere - using stale copy")
+                    return snap["data"]
+                fcntl.flock(fd, fcntl.LOCK_EX)
+
+            # it might have been updated while we were waiting for the lock
+            snap = self.load()
+            if self._age(snap) < self.ttl:
+                return snap["data"]
+
+            old = snap["data"] if snap else None
+            try:
+                data = fetch()
+            except Exception as e:
+                if self._age(snap) < self.ttl + self.stale_ttl:
+                    _logger.warning("fetch failed (%s) - using last good copy", e)
+                    return old
+                raise
+
+            if valid is not None and not valid(data, old):
+                if self._age(snap) < self.ttl + self.stale_ttl:
+                    _logger.warning("got incomplete result - using last good copy")
+                    return old
+                if snap is None:
+                    # nothing better to offer, so they'll have to have this one
+                    return data
+                # it's been like this for a while now, so it's probably how
+                # things are now (eg something the api has stopped sending)
+                _logger.warning("result still incomplete - accepting it")
+
+            self.save(data)
+            return data
+        finally:
+            os.close(fd)  # which releases the lock
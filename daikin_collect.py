@@ -0,0 +1,203 @@
+"""Collect samples from several sources, each at its own rate.
+
+daikin-zappi.py used to read the myenergi CT clamp and the Daikin in
+the same loop, so the power was only sampled as often as the Daikin
+quota allows. Here each Source runs in its own thread, on its own
+interval, and the timestamped samples from all of them come out of one
+queue:
+
+    collector = Collector([DaikinSource(daikin, scheduler), power_source])
+    for sample in collector.samples():
+        ...
+
+An Aligner then lines them up with the samples from one source (usually
+the Daikin): each time that produces a sample, the others are summarised
+since the previous one - the time-weighted mean, and the integral (eg the
+power turned into energy).
+"""
+
+import logging
+import math
+import queue
+import threading
+import time
+
+from collections import namedtuple
+from typing import Callable, Dict, Iterator, List, Optional
+
+from daikin_fields import SENSORS, FieldSpec
+
+_logger = logging.getLogger(__name__)
+
+Sample = namedtuple("Sample", "time source values")
+
+Aligned = namedtuple("Aligned", "time values integrals")
+
+
+class Source:
+    """Something to be sampled. Subclasses set name and interval (seconds),
+    and provide read(), which returns a dictionary of values, or None
+    if there's nothing new."""
+
+    name = "source"
+    interval = 60
+
+    def read(self) -> Optional[Dict[str, float]]:
+        raise NotImplementedError
+
+    def next_time(self, now: float) -> float:
+        """When the next sample is due - lined up with the clock"""
+        offset = time.localtime(now).tm_gmtoff
+        return (math.floor((now + offset) / self.interval) + 1) * self.interval - offset
+
+
+class FunctionSource(Source):
+    """A source which just calls a function, eg
+
+    FunctionSource("zappi", 60, lambda: {"power": -zappi_status()["ectp3"]})
+    """
+
+    def __init__(self, name: str, interval: float, fn: Callable[[], dict]):
+        self.name = name
+        self.interval = interval
+        self.fn = fn
+
+    def read(self) -> Optional[Dict[str, float]]:
+        return self.fn()
+
+
+class DaikinSource(Source):
+    """The Daikin, polled as often as the PollScheduler says.
+
+    The result is archived if there's an Archive, and any pending changes
+    in a PatchQueue are sent after each poll (so that the Daikin is only
+    ever used from this source's thread).
+    """
+
+    name = "daikin"
+
+    def __init__(
+        self,
+        daikin,
+        scheduler,
+        archive=None,
+        patches=None,
+        spec: FieldSpec = SENSORS,
+    ):
+        self.daikin = daikin
+        self.scheduler = scheduler
+        self.archive = archive
+        self.patches = patches
+        self.spec = spec
+        self.last: Optional[Dict[str, float]] = None
+
+    def next_time(self, now: float) -> float:
+        return self.scheduler.next_time(now)
+
+    def read(self) -> Optional[Dict[str, float]]:
+        ok, gw = self.scheduler.poll(self.daikin.poll, self.daikin.device)
+        if not ok:
+            return None
+        now = time.time()
+        if gw is not None:
+            if self.archive is not None:
+                self.archive.record(now, gw)
+            s = self.spec.extract(gw, self.daikin.device)
+            if not s.complete():
+                _logger.warning("Hmm - incomplete results: %s", s)
+            self.last = s.as_dict()
+        if self.patches is not None:
+            self.patches.flush()
+        # even if nothing has changed, it's still a sample
+        return self.last
+
+
+class Collector:
+    def __init__(self, sources: List[Source]):
+        self.sources = sources
+        self.queue: "queue.Queue[Sample]" = queue.Queue()
+        self.stop = threading.Event()
+        self._lock = threading.Lock()  # so samples are queued in time order
+        self.threads: List[threading.Thread] = []
+
+    def _run(self, source: Source) -> None:
+        while not self.stop.is_set():
+            try:
+                values = source.read()
+            except Exception:
+                _logger.exception("reading %s failed", source.name)
+                values = None
+            if values is not None:
+                with self._lock:
+                    self.queue.put(Sample(time.time(), source.name, values))
+            self.stop.wait(max(0.0, source.next_time(time.time()) - time.time()))
+
+    def start(self) -> None:
+        for source in self.sources:
+            t = threading.Thread(
+                target=self._run, args=(source,), name=source.name, daemon=True
+            )
+            t.start()
+            self.threads.append(t)
+
+    def samples(self) -> Iterator[Sample]:
+        """The samples from all the sources, as they arrive (starts the
+        sources if that hasn't been done yet)"""
+        if not self.threads:
+            self.start()
+        while not self.stop.is_set():
+            try:
+                yield self.queue.get(timeout=1)
+            except queue.Empty:
+                pass
+
+
+class Aligner:
+    """Lines up the samples from all the sources with those from primary."""
+
+    def __init__(self, primary: str = "daikin"):
+        self.primary = primary
+        self.since: Optional[float] = None  # time of the last primary sample
+        # the samples from the other sources since then (plus the one
+        # before, whose values held at the start of the period)
+        self.pending: Dict[str, List[Sample]] = {}
+
+    def add(self, sample: Sample) -> Optional[Aligned]:
+        """Add a sample. If it's from the primary source, returns its values
+        together with the time-weighted means of the other sources' values
+        since the previous one, and their integrals (value * seconds)."""
+        if sample.source != self.primary:
+            self.pending.setdefault(sample.source, []).append(sample)
+            return None
+
+        start, end = self.since, sample.time
+        self.since = end
+        values = dict(sample.values)
+        integrals: Dict[str, float] = {}
+        for source, samples in self.pending.items():
+            if start is not None:
+                totals, covered = self._integrate(samples, start, end)
+                integrals.update(totals)
+                values.update((k, v / covered[k]) for k, v in totals.items())
+            # keep the latest, as it holds into the next period
+            self.pending[source] = samples[-1:]
+        return Aligned(end, values, integrals)
+
+    @staticmethod
+    def _integrate(samples: List[Sample], start: float, end: float):
+        """Integrate the values over start..end, taking each one to hold
+        until the next sample. Returns the integrals, and how many seconds
+        each one covers (which is less than the whole period if the source
+        has only just started)"""
+        totals: Dict[str, float] = {}
+        covered: Dict[str, float] = {}
+        for i, s in enumerate(samples):
+            t0 = max(start, s.time)
+            t1 = min(end, samples[i + 1].time if i + 1 < len(samples) else end)
+            if t1 <= t0:
+                continue
+            for k, v in s.values.items():
+                if v is not None:
+                    totals[k] = totals.get(k, 0.0) + v * (t1 - t0)
+                    covered[k] = covered.get(k, 0.0) + (t1 - t0)
+        return totals, covered
@@ -0,0 +1,108 @@
+"""Pull a few named values out of the gateway-devices response.
+
+The gateway-devices response is quite large (30k or so), but most of
+the time we want just a handful of temperatures from deep inside it.
+A FieldSpec is a set of named paths, like
+
+    outdoor="climateControlMainZone/sensoryData/value/outdoorTemperature/value"
+
+where the first part is the embeddedId of the management point, and
+the rest are the keys to follow down from there.
+
+When parsing the raw response, any key which doesn't appear in any
+of the paths is thrown away as soon as the json decoder has built the
+object containing it, so the full tree is never held in memory. The
+values end up in a small object with __slots__ for each field. A value
+which is missing (the api sometimes returns partial results) comes
+back as None.
+"""
+
+import json
+
+from typing import Iterable, Optional, Union
+
+
+class Snapshot:
+    """Base class for the objects returned by FieldSpec.extract()"""
+
+    __slots__ = ()
+
+    def complete(self) -> bool:
+        """True if all the fields were found"""
+        return all(getattr(self, f) is not None for f in self.__slots__)
+
+    def as_dict(self) -> dict:
+        return {f: getattr(self, f) for f in self.__slots__}
+
+    def __repr__(self):
+        fields = ", ".join(f"{f}={getattr(self, f)!r}" for f in self.__slots__)
+        return f"{type(self).__name__}({fields})"
+
+
+class FieldSpec:
+    """A set of named paths into the management points."""
+
+    def __init__(self, name: str = "Snapshot", **fields: str):
+        self.paths = {f: tuple(path.split("/")) for f, path in fields.items()}
+
+        # the keys we need to keep while parsing
+        keep = {"id", "embeddedId", "managementPoints"}
+        for path in self.paths.values():
+            keep.update(path)
+        self.keep = frozenset(keep)
+
+        self.snapshot = type(name, (Snapshot,), {"__slots__": tuple(fields)})
+
+    def _prune(self, pairs: Iterable) -> dict:
+        keep = self.keep
+        return {k: v for k, v in pairs if k in keep}
+
+    def parse(self, body: Union[bytes, str]) -> list:
+        """Parse a raw gateway-devices response, keeping only what we need"""
+        return json.loads(body, object_pairs_hook=self._prune)
+
+    def extract_points(self, mp: dict) -> Snapshot:
+        """Extract the fields from a dictionary of management points,
+        keyed by embeddedId (as returned by Daikin.management_points())
+        """
+        snap = self.snapshot()
+        for f, path in self.paths.items():
+            node = mp
+            for key in path:
+                node = node.get(key) if isinstance(node, dict) else None
+                if node is None:
+                    break
+            setattr(snap, f, node)
+        return snap
+
+    def extract(self, gw: list, device: Optional[str] = None) -> Snapshot:
+        """Extract the fields from a gateway-devices list (parsed or pruned).
+
+        Takes the first gateway device, unless a device id is given.
+        """
+        mps = []
+        for g in gw:
+            if device is None or g.get("id") == device:
+                mps = g.get("managementPoints", [])
+                break
+        return self.extract_points({item.get("embeddedId"): item for item in mps})
+
+    def extract_raw(self, body: Union[bytes, str], device: Optional[str] = None) -> Snapshot:
+        """Parse and extract in one go"""
+        return self.extract(self.parse(body), device)
+
+
+# The values that the monitor scripts log.
+# (Should the setpoints be "auto", or "heating" ?)
+_setpoints = "climateControlMainZone/temperatureControl/value/operationModes/auto/setpoints"
+_sensors = "climateControlMainZone/sensoryData/value"
+
+SENSORS = FieldSpec(
+    "Sensors",
+    outdoor=f"{_sensors}/outdoorTemperature/value",
+    room=f"{_sensors}/roomTemperature/value",
+    lwt=f"{_sensors}/leavingWaterTemperature/value",
+    target=f"{_setpoints}/roomTemperature/value",
+    offset=f"{_setpoints}/leavingWaterOffset/value",
+    hw="domesticHotWaterTank/sensoryData/value/tankTemperature/value",
+)
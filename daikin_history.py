@@ -0,0 +1,197 @@
+"""An archive of the consumption figures.
+
+The consumptionData in the management points has three arrays for each
+of heating (and cooling):
+    d - 24 two-hourly figures: yesterday then today
+    w - 14 daily figures: last week then this week (starting on Mondays)
+    m - 24 monthly figures: last year then this year
+each relative to the day it was fetched.
+
+This turns the array positions into absolute periods, like "2024-10-25T14"
+(the 2 hours from 14:00), "2024-10-25" or "2024-10", and merges them
+into a json file keyed on those, so each period is only ever stored once.
+Only complete periods are kept - the in-progress ones are still changing.
+
+Since all three arrays come in the same response, each fetch fills in
+the last fortnight of days and the last two years of months, so a missed
+cron run mostly gets backfilled by the next one. The series are also
+checked against each other - where a day has all 12 two-hourly figures,
+they ought to add up to the daily figure, and similarly the days in a
+month - and a coarser figure which is missing is filled in from the
+finer ones if they're all there.
+"""
+
+import calendar
+import datetime
+import logging
+import pathlib
+
+from typing import Dict, List, Optional
+
+from daikin_lock import locked_file, read_json, write_json
+from daikin_store import Store
+
+_logger = logging.getLogger(__name__)
+
+RESOLUTIONS = ("d", "w", "m")
+
+
+def period_keys(want: str, today: datetime.date) -> List[str]:
+    """The period for each position in a d/w/m array fetched on day 'today'"""
+    if want == "d":
+        yesterday = today - datetime.timedelta(days=1)
+        days = (yesterday, today)
+        return [f"{day}T{hour:02d}" for day in days for hour in range(0, 24, 2)]
+    if want == "w":
+        # starts on monday of last week
+        start = today - datetime.timedelta(days=today.weekday() + 7)
+        return [str(start + datetime.timedelta(days=i)) for i in range(14)]
+    return [
+        f"{year}-{month:02d}"
+        for year in (today.year - 1, today.year)
+        for month in range(1, 13)
+    ]
+
+
+def period_end(key: str) -> datetime.datetime:
+    """The time at which a period is complete"""
+    if "T" in key:
+        return datetime.datetime.fromisoformat(key + ":00") + datetime.timedelta(
+            hours=2
+        )
+    if key.count("-") == 2:
+        return datetime.datetime.fromisoformat(key) + datetime.timedelta(days=1)
+    year, month = map(int, key.split("-"))
+    return datetime.datetime(year + month // 12, month % 12 + 1, 1)
+
+
+def previous_period(want: str, today: datetime.date) -> List[str]:
+    """The keys making up the most recent complete day, week or year"""
+    if want == "d":
+        return period_keys("d", today)[:12]  # yesterday
+    if want == "w":
+        return period_keys("w", today)[:7]  # last week
+    return period_keys("m", today)[:12]  # last year
+
+
+class History:
+    """The archive file, holding
+
+    { device: { "embeddedId/mode": { "d"|"w"|"m": { period: value } } } }
+    """
+
+    default_file = Store.default_dir / "consumption.json"
+
+    def __init__(self, path: Optional[pathlib.Path] = None):
+        self.path = path or self.default_file
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+
+    def load(self) -> dict:
+        with locked_file(self.path, shared=True) as f:
+            return read_json(f, {})
+
+    def merge(
+        self, device: str, mp: dict, now: Optional[datetime.datetime] = None
+    ) -> int:
+        """Merge the consumption figures from a set of management points
+        (as returned by Daikin.management_points()).
+
+        Returns the number of periods that weren't already stored.
+        """
+
+        now = now or datetime.datetime.now()
+        added = 0
+        with locked_file(self.path) as f:
+            data = read_json(f, {})
+            dev = data.setdefault(device, {})
+            for emb, point in mp.items():
+                try:
+                    electrical = point["consumptionData"]["value"]["electrical"]
+                except KeyError:
+                    continue
+                for mode, arrays in electrical.items():
+                    series = dev.setdefault(f"{emb}/{mode}", {})
+                    for want in RESOLUTIONS:
+                        values = arrays.get(want)
+                        if values:
+                            added += self._merge_one(
+                                series.setdefault(want, {}), want, values, now
+                            )
+                    self._reconcile(series)
+            write_json(f, data)
+        return added
+
+    def _merge_one(self, stored: dict, want: str, values: list, now) -> int:
+        added = 0
+        for key, value in zip(period_keys(want, now.date()), values):
+            if value is None or period_end(key) > now:
+                continue  # not complete yet
+            if key not in stored:
+                added += 1
+            elif stored[key] != value:
+                _logger.info(
+                    "%s %s changed from %s to %s", want, key, stored[key], value
+                )
+            stored[key] = value
+        return added
+
+    def _reconcile(self, series: dict) -> None:
+        """Check the finer figures against the coarser ones, and fill in
+        any missing coarse figures from complete sets of finer ones.
+        """
+        self._rollup(series.setdefault("d", {}), series.setdefault("w", {}), 10, "day")
+        self._rollup(series["w"], series.setdefault("m", {}), 7, "month")
+
+    def _rollup(self, fine: dict, coarse: dict, prefix: int, what: str) -> None:
+        groups: Dict[str, list] = {}
+        for key, value in fine.items():
+            groups.setdefault(key[:prefix], []).append(value)
+
+        for key, parts in groups.items():
+            if what == "day":
+                expected = 12
+            else:
+                year, month = map(int, key.split("-"))
+                expected = calendar.monthrange(year, month)[1]
+            if len(parts) != expected:
+                continue
+            total = sum(parts)
+            if key not in coarse:
+                _logger.info("backfilling %s %s from finer figures", what, key)
+                coarse[key] = total
+            elif abs(coarse[key] - total) > 0.5 * (expected + 1):
+                # more than can be explained by rounding
+                _logger.warning(
+                    "%s %s is %s but the parts add up to %s",
+                    what,
+                    key,
+                    coarse[key],
+                    total,
+                )
+
+    def due(
+        self,
+        want: str,
+        device: Optional[str] = None,
+        now: Optional[datetime.datetime] = None,
+    ) -> bool:
+        """Has a day / week / year completed that we haven't got yet?
+
+        If so, it's worth fetching from the api. With no device, checks all
+        the devices seen so far.
+        """
+        now = now or datetime.datetime.now()
+        key = previous_period(want, now.date())[-1]
+        data = self.load()
+        devices = [device] if device else list(data)
+        if not devices or any(d not in data for d in devices):
+            return True
+        stored = [s[want] for d in devices for s in data[d].values() if s.get(want)]
+        return not stored or any(key not in s for s in stored)
+
+    def series(
+        self, device: str, emb: str, want: str, mode: str = "heating"
+    ) -> Dict[str, float]:
+        """All the stored figures for one management point, in time order"""
+        stored = self.load().get(device, {}).get(f"{emb}/{mode}", {}).get(want, {})
+        return dict(sorted(stored.items()))
@@ -0,0 +1,73 @@
+"""Helpers for sharing small state files between processes.
+
+The daikin scripts keep a few little json files in /tmp (the key,
+the quota ledger, ...) which can be read and rewritten by several
+processes at the same time, so they all need the same flock()
+dance as Daikin.check_key_expiry()
+"""
+
+import contextlib
+import fcntl
+import json
+import os
+import pathlib
+
+from typing import Iterator, TextIO
+
+
+@contextlib.contextmanager
+def locked_file(path: pathlib.Path, shared: bool = False) -> Iterator[TextIO]:
+    """Open a file read-write (creating it if necessary) and flock() it.
+
+    The lock is released when the block exits - it would vanish when
+    the file is closed anyway, but this saves thinking about it.
+    """
+
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+    with os.fdopen(fd, "r+") as f:
+        fcntl.flock(fd, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield f
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+
+
+@contextlib.contextmanager
+def try_lock(path: pathlib.Path) -> Iterator[bool]:
+    """flock() a file if nobody else has, without waiting.
+
+    Yields whether it got the lock. The file is only there to be locked -
+    nothing is read from or written to it.
+    """
+
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+        else:
+            yield True
+    finally:
+        os.close(fd)  # which releases the lock
+
+
+def read_json(f: TextIO, default=None):
+    """Read json from an already-open file, from the start.
+
+    An empty or mangled file gives the default rather than an exception,
+    since these files only hold state that we can cope with losing.
+    """
+    f.seek(0)
+    try:
+        return json.load(f)
+    except ValueError:
+        return default
+
+
+def write_json(f: TextIO, data) -> None:
+    """Overwrite an already-open (and locked) file with some json"""
+    f.seek(0)
+    json.dump(data, f)
+    f.truncate()  # in case new data was shorter
+    f.flush()
@@ -0,0 +1,215 @@
+"""Counters and timings for what the Daikin class gets up to.
+
+The client reports events here with emit(), eg
+    emit("request", method="GET", status=200, seconds=0.4, bytes=31000, retries=0)
+and they are added up into a few counters and histograms. You can also
+add your own hooks, which get called with each event.
+
+The totals can be rendered in the Prometheus text format, and either
+written to a file every so often (eg for node_exporter's textfile
+collector) or served on a local port. The monitor scripts turn this on
+if the environment variable DAIKIN_METRICS is set - to a port number to
+serve them, or to a file name to write them to.
+
+Events:
+    request   method, endpoint, status, seconds, bytes, wire_bytes, retries
+              (bytes is the size of the body, wire_bytes what came over the
+              network for it, which is less if it was compressed - if known)
+    lock      name, seconds      (time spent waiting for a file lock)
+    refresh   ok                 (a key refresh was attempted)
+    quota     remaining          (tokens left in the quota ledger)
+"""
+
+import atexit
+import logging
+import os
+import pathlib
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Tuple
+
+_logger = logging.getLogger(__name__)
+
+
+class Histogram:
+    """Cumulative buckets, as Prometheus likes them"""
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        for i, limit in enumerate(self.buckets):
+            if value <= limit:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+
+_TIME_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.hooks: List[Callable[..., None]] = []
+        self.counters: Dict[Tuple[str, Tuple], float] = {}
+        self.gauges: Dict[Tuple[str, Tuple], float] = {}
+        self.histograms: Dict[Tuple[str, Tuple], Histogram] = {}
+        self.changed = False  # since the last write_every() dump
+
+    def _inc(self, name: str, labels: Tuple = (), by: float = 1) -> None:
+        key = (name, labels)
+        self.counters[key] = self.counters.get(key, 0) + by
+
+    def _observe(self, name: str, labels: Tuple, value: float) -> None:
+        key = (name, labels)
+        if key not in self.histograms:
+            self.histograms[key] = Histogram(_TIME_BUCKETS)
+        self.histograms[key].observe(value)
+
+    def emit(self, event: str, **fields) -> None:
+        with self.lock:
+            self.changed = True
+            if event == "request":
+                method = (("method", fields["method"]),)
+                self._inc(
+                    "daikin_requests_total",
+                    method + (("status", str(fields["status"])),),
+                )
+                self._observe("daikin_request_seconds", method, fields["seconds"])
+                endpoint = method + (("endpoint", fields.get("endpoint", "")),)
+                self._inc(
+                    "daikin_response_bytes_total", endpoint, fields.get("bytes", 0)
+                )
+                if "wire_bytes" in fields:
+                    self._inc("daikin_wire_bytes_total", endpoint, fields["wire_bytes"])
+                self._inc("daikin_retries_total", method, fields.get("retries", 0))
+            elif event == "lock":
+                self._observe(
+                    "daikin_lock_wait_seconds",
+                    (("lock", fields["name"]),),
+                    fields["seconds"],
+                )
+            elif event == "refresh":
+                self._inc(
+                    "daikin_key_refreshes_total", (("ok", str(fields["ok"]).lower()),)
+                )
+            elif event == "quota":
+                self.gauges[("daikin_quota_remaining", ())] = fields["remaining"]
+
+        for hook in self.hooks:
+            try:
+                hook(event, **fields)
+            except Exception:
+                _logger.exception("metrics hook failed")
+
+    def render(self) -> str:
+        """The current values in Prometheus text format"""
+
+        def fmt(labels: Tuple) -> str:
+            if not labels:
+                return ""
+            return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+        lines = []
+        with self.lock:
+            for kind, table in (("counter", self.counters), ("gauge", self.gauges)):
+                for name in sorted({n for n, _ in table}):
+                    lines.append(f"# TYPE {name} {kind}")
+                    for (n, labels), value in sorted(table.items()):
+                        if n == name:
+                            lines.append(f"{name}{fmt(labels)} {value}")
+            for name in sorted({n for n, _ in self.histograms}):
+                lines.append(f"# TYPE {name} histogram")
+                for (n, labels), h in sorted(
+                    self.histograms.items(), key=lambda i: i[0]
+                ):
+                    if n != name:
+                        continue
+                    for limit, count in zip(h.buckets, h.counts):
+                        lines.append(
+                            f"{name}_bucket{fmt(labels + (('le', limit),))} {count}"
+                        )
+                    lines.append(
+                        f"{name}_bucket{fmt(labels + (('le', '+Inf'),))} {h.count}"
+                    )
+                    lines.append(f"{name}_sum{fmt(labels)} {h.sum}")
+                    lines.append(f"{name}_count{fmt(labels)} {h.count}")
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path: pathlib.Path) -> None:
+        """Write the metrics to a file (atomically, so readers never see half of it)"""
+        # a name of its own, in case another thread (or process) is at it too
+        tmp = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        tmp.write_text(self.render())
+        os.replace(tmp, path)
+
+    def write_every(self, path: pathlib.Path, interval: float = 15) -> None:
+        """dump() to path from a background thread, every interval seconds
+        if anything has happened, and once more when the program exits"""
+
+        def dump_if_changed():
+            with self.lock:
+                changed, self.changed = self.changed, False
+            if changed:
+                self.dump(path)
+
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    dump_if_changed()
+                except OSError as e:
+                    _logger.warning("cannot write metrics to %s: %s", path, e)
+
+        threading.Thread(target=run, name="metrics", daemon=True).start()
+        atexit.register(dump_if_changed)
+
+    def serve(self, port: int, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+        """Serve the metrics over http from a background thread"""
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+# the one everybody uses
+metrics = Metrics()
+emit = metrics.emit
+
+
+def add_hook(hook: Callable[..., None]) -> None:
+    """Have hook(event, **fields) called for every event"""
+    metrics.hooks.append(hook)
+
+
+def export_from_env() -> None:
+    """Serve or dump the metrics according to $DAIKIN_METRICS, if set"""
+    where = os.environ.get("DAIKIN_METRICS")
+    if not where:
+        return
+    if where.isdigit():
+        metrics.serve(int(where))
+        _logger.info("serving metrics on port %s", where)
+    else:
+        metrics.write_every(pathlib.Path(where))
+        _logger.info("writing metrics to %s", where)
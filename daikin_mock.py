@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+
+"""A local stand-in for the Daikin cloud, for testing and benchmarks.
+
+It implements just enough of the token endpoint and the api to keep
+the Daikin class happy:
+    POST /v1/oidc/token
+    GET  /v1/gateway-devices
+    GET  /v1/gateway-devices/<id>
+    PATCH /v1/gateway-devices/<id>/management-points/<embeddedId>/characteristics/<name>
+
+and it can be told to misbehave in the ways the real one does: being
+slow, rate-limiting, returning empty results, and expiring tokens.
+It also counts everything, so you can see how many requests an
+operation actually took.
+
+A refresh token can only be used once (as with the real thing), so
+if two clients race to refresh, the loser gets an error - which is
+exactly the failure that the key-file locking is meant to prevent.
+
+Point a Daikin at it by overriding the urls, eg
+
+    mock = MockOnecta()
+    mock.start()
+    Daikin.idp_url = mock.idp_url
+    Daikin.api_url = mock.api_url
+
+Or run it on its own with: daikin_mock.py [port]
+"""
+
+import copy
+import json
+import random
+import sys
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+
+def sample_gateway(device_id: str) -> dict:
+    """Something that looks roughly like a gateway device from the real api"""
+
+    def consumption():
+        return {
+            "value": {
+                "electrical": {
+                    "heating": {
+                        "d": [1] * 12 + [1] * 6 + [None] * 6,
+                        "w": [12] * 7 + [12] * 3 + [None] * 4,
+                        "m": [300] * 12 + [300] * 10 + [None] * 2,
+                    }
+                }
+            }
+        }
+
+    setpoints = {
+        "roomTemperature": {"settable": True, "value": 20.5, "minValue": 12},
+        "leavingWaterOffset": {"settable": True, "value": 0, "minValue": -10},
+    }
+    return {
+        "_id": device_id,
+        "id": device_id,
+        "deviceModel": "Altherma",
+        "type": "heat-pump",
+        "isCloudConnectionUp": {"settable": False, "value": True},
+        "managementPoints": [
+            {
+                "embeddedId": "gateway",
+                "managementPointType": "gateway",
+                "firmwareVersion": {"settable": False, "value": "3.1.7"},
+                "macAddress": {"settable": False, "value": "00:00:00:00:00:00"},
+                "modelInfo": {"settable": False, "value": "BRP069A78"},
+                # the real thing has lots of this sort of stuff
+                "errors": {"settable": False, "value": ["-"] * 200},
+            },
+            {
+                "embeddedId": "climateControlMainZone",
+                "managementPointType": "climateControl",
+                "onOffMode": {"settable": True, "value": "on"},
+                "operationMode": {"settable": True, "value": "heating"},
+                "sensoryData": {
+                    "settable": False,
+                    "value": {
+                        "roomTemperature": {"value": 20.3},
+                        "outdoorTemperature": {"value": 8},
+                        "leavingWaterTemperature": {"value": 35},
+                    },
+                },
+                "temperatureControl": {
+                    "settable": True,
+                    "value": {
+                        "operationModes": {
+                            "auto": {"setpoints": copy.deepcopy(setpoints)},
+                            "heating": {"setpoints": copy.deepcopy(setpoints)},
+                        }
+                    },
+                },
+                "consumptionData": consumption(),
+            },
+            {
+                "embeddedId": "domesticHotWaterTank",
+                "managementPointType": "domesticHotWaterTank",
+                "powerfulMode": {"settable": True, "value": "off"},
+                "sensoryData": {
+                    "settable": False,
+                    "value": {"tankTemperature": {"value": 48}},
+                },
+                "consumptionData": consumption(),
+            },
+        ],
+    }
+
+
+class MockOnecta:
+    """The server, plus its state and knobs."""
+
+    def __init__(self, port: int = 0, devices: int = 1):
+        # knobs
+        self.latency = 0.0  # seconds added to every request
+        self.token_lifetime = 3600  # "expires_in" for new tokens
+        self.daily_limit = 200  # 429 once this many api requests are made
+        self.error_rate = 0.0  # fraction of api requests that get a 429 anyway
+        self.empty_rate = 0.0  # fraction of gateway-devices that come back empty
+
+        # state
+        self.gateways = [sample_gateway(f"device-{i}") for i in range(devices)]
+        self.tokens = {}  # access token -> expiry time
+        self.refresh_token = None  # the only one that will work
+        self.serial = 0
+        self.counts = {}  # what's been asked for
+        self.lock = threading.Lock()
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), self._handler())
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        self.idp_url = f"http://127.0.0.1:{self.port}/v1/oidc"
+        self.api_url = f"http://127.0.0.1:{self.port}/v1"
+
+    def start(self) -> None:
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def count(self, what: str) -> None:
+        with self.lock:
+            self.counts[what] = self.counts.get(what, 0) + 1
+
+    def reset_counts(self) -> None:
+        with self.lock:
+            self.counts = {}
+
+    def api_requests(self) -> int:
+        return sum(n for what, n in self.counts.items() if what.startswith("api "))
+
+    def new_key(self) -> dict:
+        """Issue a new access / refresh token pair"""
+        with self.lock:
+            self.serial += 1
+            access = f"access-{self.serial}"
+            self.tokens[access] = time.time() + self.token_lifetime
+            self.refresh_token = f"refresh-{self.serial}"
+            return {
+                "access_token": access,
+                "refresh_token": self.refresh_token,
+                "token_type": "Bearer",
+                "expires_in": self.token_lifetime,
+            }
+
+    def expire_tokens(self) -> None:
+        """Make all current access tokens invalid"""
+        with self.lock:
+            self.tokens = {}
+
+    def _handler(self):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def reply(self, status: int, body=None, headers=None):
+                data = b"" if body is None else json.dumps(body).encode()
+                self.send_response(status)
+                for k, v in (headers or {}).items():
+                    self.send_header(k, str(v))
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_POST(self):
+                if mock.latency:
+                    time.sleep(mock.latency)
+                url = urlsplit(self.path)
+                if url.path != "/v1/oidc/token":
+                    return self.reply(404)
+                args = {k: v[0] for k, v in parse_qs(url.query).items()}
+                grant = args.get("grant_type")
+                if grant == "refresh_token":
+                    mock.count("refresh")
+                    if args.get("refresh_token") != mock.refresh_token:
+                        # used twice, or just wrong
+                        mock.count("bad refresh")
+                        return self.reply(400, {"error": "invalid_grant"})
+                elif grant == "authorization_code":
+                    mock.count("code")
+                else:
+                    return self.reply(400, {"error": "unsupported_grant_type"})
+                self.reply(200, mock.new_key())
+
+            def api(self, method: str):
+                if mock.latency:
+                    time.sleep(mock.latency)
+                path = urlsplit(self.path).path
+                mock.count(f"api {method}")
+
+                auth = self.headers.get("Authorization", "")
+                expiry = mock.tokens.get(auth.removeprefix("Bearer "), 0)
+                if expiry < time.time():
+                    mock.count("unauthorized")
+                    return self.reply(401, {"message": "token expired"})
+
+                used = mock.api_requests()
+                headers = {
+                    "X-RateLimit-Limit-day": mock.daily_limit,
+                    "X-RateLimit-Remaining-day": max(0, mock.daily_limit - used),
+                    "X-RateLimit-Limit-minute": 20,
+                    "X-RateLimit-Remaining-minute": 20,
+                }
+                if used > mock.daily_limit or random.random() < mock.error_rate:
+                    mock.count("429")
+                    headers["Retry-After"] = 60
+                    return self.reply(429, {"message": "rate limited"}, headers)
+
+                parts = path.strip("/").split("/")[1:]  # drop the "v1"
+                if method == "GET":
+                    return self.get(parts, headers)
+                return self.patch(parts, headers)
+
+            def get(self, parts, headers):
+                if parts == ["gateway-devices"]:
+                    if random.random() < mock.empty_rate:
+                        mock.count("empty")
+                        return self.reply(200, [], headers)
+                    return self.reply(200, mock.gateways, headers)
+                if len(parts) == 2 and parts[0] == "gateway-devices":
+                    for gw in mock.gateways:
+                        if gw["id"] == parts[1]:
+                            return self.reply(200, gw, headers)
+                self.reply(404, {"message": "not found"}, headers)
+
+            def patch(self, parts, headers):
+                # gateway-devices/<id>/management-points/<emb>/characteristics/<name>
+                if len(parts) != 6 or parts[2] != "management-points":
+                    return self.reply(404, {"message": "not found"}, headers)
+                length = int(self.headers.get("Content-Length", 0))
+                payload = json.loads(self.rfile.read(length) or b"{}")
+                for gw in mock.gateways:
+                    if gw["id"] != parts[1]:
+                        continue
+                    for mp in gw["managementPoints"]:
+                        if mp["embeddedId"] == parts[3] and parts[5] in mp:
+                            node = mp[parts[5]]
+                            keys = [k for k in payload.get("path", "").split("/") if k]
+                            if keys:
+                                node = node["value"]
+                                for k in keys:
+                                    node = node[k]
+                            node["value"] = payload["value"]
+                            return self.reply(204, None, headers)
+                self.reply(404, {"message": "not found"}, headers)
+
+            def do_GET(self):
+                self.api("GET")
+
+            def do_PATCH(self):
+                self.api("PATCH")
+
+        return Handler
+
+
+def main():
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8080
+    mock = MockOnecta(port)
+    print(f"idp_url = {mock.idp_url}\napi_url = {mock.api_url}")
+    try:
+        mock.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+"""A queue for changes to the settings, to avoid wasting requests on them.
+
+Daikin.patch() sends the request straight away, even if the setting
+already has that value, or if it's going to be changed again a minute
+later. Writes come out of the same 200-a-day quota, so instead they can
+be submitted to a PatchQueue, which
+  - drops any change which wouldn't actually change anything, comparing
+    it with the latest management points we know about
+  - only keeps the most recent value for each setting, and waits until
+    it has stopped changing for a little while before sending it
+  - keeps the pending changes in a (locked) file, so that they survive
+    the script being restarted, or the quota running out, and can be
+    sent by whichever process calls flush() next. Only one process sends
+    at a time (the monitors tend to flush at the same moment) - any others
+    just leave it to that one.
+"""
+
+import logging
+import pathlib
+import time
+
+from typing import Any, Optional
+
+import requests
+
+from daikin_lock import locked_file, read_json, try_lock, write_json
+from daikin_quota import QuotaExceeded
+
+_logger = logging.getLogger(__name__)
+
+
+def current_value(mp: dict, name: str, path: Optional[str]) -> Any:
+    """Look up the current value of a setting in a dictionary of management
+    points, given the name and path as passed to Daikin.patch()
+
+    eg "climateControlMainZone/characteristics/temperatureControl"
+    with path "/operationModes/heating/setpoints/roomTemperature"
+    is mp["climateControlMainZone"]["temperatureControl"]["value"]["operationModes"]...
+    """
+    emb, _, characteristic = name.split("/")
+    try:
+        node = mp[emb][characteristic]
+        keys = [k for k in (path or "").split("/") if k]
+        if keys:
+            node = node["value"]
+            for key in keys:
+                node = node[key]
+        return node["value"]
+    except (KeyError, TypeError):
+        return None
+
+
+class PatchQueue:
+    """Pending changes for one Daikin, stored in a file shared between processes."""
+
+    # how long flush() allows for sending each change
+    timeout = 30
+
+    def __init__(
+        self, daikin, path: Optional[pathlib.Path] = None, window: float = 120
+    ):
+        """window is how long a setting has to stay unchanged before it's sent"""
+        self.daikin = daikin
+        self.path = path or daikin.key_file.with_name("daikin_patches.json")
+        self.window = window
+
+    def _known(self, data: dict, key: str, device, name: str, path) -> Any:
+        """The latest value we know of for a setting - either from the
+        management points, or what we last sent, whichever is newer.
+        """
+        value, stamp = None, 0
+        state, state_time = self.daikin.known_state(device)
+        if state is not None:
+            value, stamp = current_value(state, name, path), state_time
+        sent = data["sent"].get(key)
+        if sent and sent["time"] > stamp:
+            value = sent["value"]
+        return value
+
+    def submit(self, name: str, device: Optional[str] = None, **payload) -> bool:
+        """Queue a patch - same arguments as Daikin.patch()
+
+        Returns False if it was dropped because it wouldn't change anything.
+        """
+        device = device or self.daikin.device
+        key = f"{device}:{name}{payload.get('path', '')}"
+        with locked_file(self.path) as f:
+            data = read_json(f, None) or {"pending": {}, "sent": {}}
+            known = self._known(data, key, device, name, payload.get("path"))
+            if payload.get("value") == known:
+                if data["pending"].pop(key, None):
+                    _logger.info("%s set back to current value - cancelled", key)
+                    write_json(f, data)
+                return False
+            now = time.time()
+            item = data["pending"].setdefault(key, {"first": now})
+            item.update(device=device, name=name, payload=payload, last=now)
+            write_json(f, data)
+        return True
+
+    def flush(self, force: bool = False) -> int:
+        """Send any pending changes which have settled (or all of them if force).
+
+        The file isn't kept locked while they're being sent (which can mean
+        waiting for quota, or a slow server), so submit() isn't held up -
+        anything submitted meanwhile is still there afterwards. Instead
+        there's a separate lock for sending, and if another process has got
+        that, this one leaves the sending to it.
+
+        Returns the number still pending.
+        """
+        with try_lock(self.path.with_name(self.path.name + ".flush")) as mine:
+            if not mine:
+                _logger.debug("another process is sending the patches")
+                with locked_file(self.path, shared=True) as f:
+                    data = read_json(f, None) or {"pending": {}}
+                return len(data["pending"])
+            return self._send(force)
+
+    def _send(self, force: bool) -> int:
+        with locked_file(self.path) as f:
+            data = read_json(f, None) or {"pending": {}, "sent": {}}
+            now = time.time()
+            ready = {
+                key: item
+                for key, item in data["pending"].items()
+                if force or now - item["last"] >= self.window
+            }
+
+        sent, dropped = {}, []
+        try:
+            for key, item in ready.items():
+                known = self._known(
+                    data, key, item["device"], item["name"], item["payload"].get("path")
+                )
+                if item["payload"].get("value") == known:
+                    # eg an earlier send that timed out did get there after all
+                    _logger.info("%s already has that value - dropped", key)
+                    dropped.append(key)
+                    continue
+                try:
+                    self.daikin.patch(
+                        item["name"],
+                        item["device"],
+                        deadline=time.time() + self.timeout,
+                        **item["payload"],
+                    )
+                except QuotaExceeded as e:
+                    _logger.warning("not sending %s yet: %s", key, e)
+                    break
+                except requests.HTTPError as e:
+                    status = e.response.status_code if e.response is not None else 500
+                    if status < 500 and status not in (401, 429):
+                        # it isn't going to work next time either
+                        _logger.error("patch %s rejected: %s", key, e)
+                        dropped.append(key)
+                        continue
+                    _logger.warning("patch %s failed, will retry: %s", key, e)
+                    break
+                except requests.Timeout as e:
+                    # it may or may not have got there - if it did, and we've
+                    # seen the new value by the time of the next flush(), it
+                    # won't be sent again
+                    _logger.warning(
+                        "patch %s timed out (may have been applied), will retry: %s",
+                        key,
+                        e,
+                    )
+                    break
+                except requests.RequestException as e:
+                    _logger.warning("patch %s failed, will retry: %s", key, e)
+                    break
+                sent[key] = time.time()
+        finally:
+            pending = self._commit(ready, sent, dropped)
+        return pending
+
+    def _commit(self, ready: dict, sent: dict, dropped: list) -> int:
+        """Take the ones that have been dealt with out of the file - unless
+        they've been changed again while we were sending them"""
+        with locked_file(self.path) as f:
+            data = read_json(f, None) or {"pending": {}, "sent": {}}
+            for key in dropped + list(sent):
+                item = data["pending"].get(key)
+                if item is not None and item["last"] == ready[key]["last"]:
+                    del data["pending"][key]
+            for key, t in sent.items():
+                data["sent"][key] = {
+                    "value": ready[key]["payload"].get("value"),
+                    "time": t,
+                }
+            write_json(f, data)
+            return len(data["pending"])
+
+    def set_temperature_control(self, name, value, device=None) -> bool:
+        """Queue a change to "roomTemperature" or "leavingWaterOffset" """
+        return self.submit(
+            "climateControlMainZone/characteristics/temperatureControl",
+            device,
+            path="/operationModes/heating/setpoints/" + name,
+            value=value,
+        )
+
+    def set_powerful_mode(self, state, device=None) -> bool:
+        """Queue turning the water immersion heater on or off"""
+        return self.submit(
+            "domesticHotWaterTank/characteristics/powerfulMode",
+            device,
+            value="on" if state else "off",
+        )
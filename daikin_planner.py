@@ -0,0 +1,425 @@
+#!/usr/bin/env python3
+
+"""Plan the leaving water offset, and hot water boosts, around a tariff.
+
+Rather than cron jobs turning the offset up and down at fixed times,
+this works out a schedule for the next day, in half hour slots, which
+keeps the house comfortable for the least cost - heating a bit more
+while the electricity is cheap, and coasting while it's expensive. It
+has to do that with only a few changes a day, as each one is a PATCH
+out of the 200 requests.
+
+It uses a very simple model of the house, fitted to the samples in the
+store (see daikin_store.py), with defaults for anything the history
+doesn't tell us:
+  - the power used is base + per_degree * (15.5 - outdoor) + per_offset * offset
+    (the power is only in the store if daikin-zappi.py has been recording)
+  - the room temperature, relative to the target, decays towards the
+    target with a time constant tau, and each degree of offset pushes
+    it up by gain degrees per hour
+
+The schedule is found by dynamic programming, backwards over the slots,
+with the state being the room temperature (as the difference from the
+target, on a grid), the offset currently set, and how many changes have
+been made so far. Each step is done with numpy over all the states at
+once - planning a day takes a couple of tens of milliseconds on a
+desktop, so a pi can easily redo it every poll. Being too far from the target costs
+comfort (per degree squared per hour, outside a band where we don't
+mind), and any heat left in (or owed to) the house at the end is valued
+at the average price, so the plan doesn't just run it down.
+
+Hot water is simpler: if the tank is below hw_min, powerful mode is
+turned on in the cheapest slot within boost_window. It turns itself off
+once the tank is hot, so that's one PATCH.
+
+    planner = Planner(Model.fit(samples))
+    plan = planner.plan(now, tariff, room=20.1, target=20.5, offset=0, hw=38, outdoor=7)
+    planner.apply(plan, PatchQueue(daikin))   # makes any change due now
+
+The changes made each day are counted in a little (locked) json file,
+so that re-planning every poll doesn't let it go over max_patches.
+
+Needs numpy. Run as a script, it fits the model to the last fortnight
+of samples, and prints the plan from the latest one (and with --apply,
+queues the change for now, if there is one).
+"""
+
+import datetime
+import json
+import logging
+import math
+import pathlib
+import sys
+import time
+
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from daikin import Daikin
+from daikin_lock import locked_file, read_json, write_json
+from daikin_patches import PatchQueue
+from daikin_store import NUMPY_DTYPE, Store
+
+_logger = logging.getLogger(__name__)
+
+SLOT = 1800  # seconds
+
+# (hour, price per kWh) - from each hour onwards, the price is that,
+# like PollScheduler's profile. Just an example, with a cheap night
+# rate and an expensive peak.
+EXAMPLE_TARIFF = [(0, 0.25), (2, 0.08), (5, 0.25), (16, 0.38), (19, 0.25)]
+
+
+def prices(tariff: Sequence[Tuple[float, float]], times: np.ndarray) -> np.ndarray:
+    """The price at each of the times, from a (hour, price) tariff"""
+    tariff = sorted(tariff)
+    local = [time.localtime(int(t)) for t in times]
+    hours = np.array([t.tm_hour + t.tm_min / 60 for t in local])
+    starts = np.array([h for h, _ in tariff])
+    values = np.array([p for _, p in tariff])
+    # before the first start, it's still the last one from the day before
+    return values[np.searchsorted(starts, hours, side="right") - 1]
+
+
+class Model:
+    """How the house responds - see the top of the file"""
+
+    base_temperature = 15.5
+
+    def __init__(
+        self,
+        base: float = 150,
+        per_degree: float = 120,
+        per_offset: float = 150,
+        tau: float = 10,
+        gain: float = 0.1,
+    ):
+        self.base = base  # W
+        self.per_degree = per_degree  # W per degree below base_temperature
+        self.per_offset = per_offset  # W per degree of offset
+        self.tau = tau  # hours
+        self.gain = gain  # degrees per hour, per degree of offset
+
+    @classmethod
+    def fit(cls, samples: np.ndarray, min_samples: int = 50) -> "Model":
+        """Fit to samples from the store (a NUMPY_DTYPE array, in time
+        order), keeping the defaults for anything that can't be fitted"""
+        m = cls()
+        s = samples
+        offset = s["offset"].astype(float)
+
+        ok = ~np.isnan(s["power"]) & ~np.isnan(s["outdoor"]) & ~np.isnan(offset)
+        if ok.sum() >= min_samples:
+            cold = np.clip(m.base_temperature - s["outdoor"][ok], 0, None)
+            varies = np.ptp(offset[ok]) > 0
+            columns = [np.ones(ok.sum()), cold] + ([offset[ok]] if varies else [])
+            coef = np.linalg.lstsq(
+                np.column_stack(columns), s["power"][ok], rcond=None
+            )[0]
+            if coef[1] > 0:
+                m.base, m.per_degree = max(0.0, coef[0]), coef[1]
+            if varies and coef[2] > 0:
+                m.per_offset = coef[2]
+
+        # pairs of consecutive samples with the room temperature, not too far
+        # apart - daikin-zappi.py's power-only records come in between, so
+        # those are left out first
+        s = s[~np.isnan(s["room"]) & ~np.isnan(s["target"])]
+        offset = s["offset"].astype(float)
+        t = s["time"].astype(float)
+        dev = (s["room"] - s["target"]).astype(float)
+        hours = np.diff(t) / 3600
+        ok = (hours > 0.05) & (hours <= 2) & ~np.isnan(offset[:-1])
+        if ok.sum() >= min_samples:
+            rate = (dev[1:] - dev[:-1])[ok] / hours[ok]
+            varies = np.ptp(offset[:-1][ok]) > 0
+            columns = [dev[:-1][ok], np.ones(ok.sum())]
+            columns += [offset[:-1][ok]] if varies else []
+            coef = np.linalg.lstsq(np.column_stack(columns), rate, rcond=None)[0]
+            # only believe it if it's sensible
+            if 1 / 100 < -coef[0] < 2:
+                m.tau = -1 / coef[0]
+            if varies and 0.005 < coef[2] < 1:
+                m.gain = coef[2]
+        return m
+
+    def power(self, outdoor: np.ndarray, offset: np.ndarray) -> np.ndarray:
+        cold = np.clip(self.base_temperature - outdoor, 0, None)
+        return np.clip(
+            self.base + self.per_degree * cold + self.per_offset * offset, 0, None
+        )
+
+    def step(self, dev: np.ndarray, offset: np.ndarray, hours: float) -> np.ndarray:
+        """Where the room temperature (relative to the target) goes next"""
+        decay = math.exp(-hours / self.tau)
+        # the offset's effect levels off in the same way
+        return decay * dev + self.gain * self.tau * (1 - decay) * offset
+
+    def __repr__(self):
+        return (
+            f"{self.base:.0f} W + {self.per_degree:.0f} W/K below"
+            f" {self.base_temperature}, {self.per_offset:.0f} W per degree of offset;"
+            f" tau {self.tau:.1f}h, gain {self.gain:.2f} K/h per degree of offset"
+        )
+
+
+class Plan:
+    """A schedule: the offset, and whether to boost the hot water, for each slot"""
+
+    def __init__(self, times, offsets, boost, room, cost, current):
+        self.times = times  # start of each slot (the first is now)
+        self.offsets = offsets  # the offset to have set during each slot
+        self.boost = boost  # whether to turn on powerful mode then
+        self.room = room  # predicted difference from the target, at each time
+        self.cost = cost  # estimated cost of the energy
+        self.current = current  # the offset set now
+
+    def changes(self) -> List[Tuple[float, str, float]]:
+        """(time, setting, value) for each change in the plan"""
+        out = []
+        previous = self.current
+        for t, o, b in zip(self.times, self.offsets, self.boost):
+            if o != previous:
+                out.append((t, "leavingWaterOffset", int(o)))
+                previous = o
+            if b:
+                out.append((t, "powerfulMode", "on"))
+        return out
+
+    def __repr__(self):
+        lines = [f"estimated cost {self.cost:.2f}"]
+        for t, what, value in self.changes():
+            lines.append(
+                f"  {time.strftime('%a %H:%M', time.localtime(t))}  {what} {value}"
+            )
+        return "\n".join(lines)
+
+
+class Planner:
+    # the offsets to choose between
+    offsets = (-3, -2, -1, 0, 1, 2, 3)
+
+    # changes per day, all told
+    max_patches = 6
+
+    # cost (in the tariff's money) per degree squared per hour, of the room
+    # being more than comfort_band from the target
+    comfort = 0.2
+    comfort_band = 0.5
+
+    # the grid for the room temperature (relative to the target)
+    span = 2.5
+    step = 0.05
+
+    # hot water
+    hw_min = 40
+    boost_window = 12 * 3600
+    boost_kwh = 2.0
+
+    def __init__(self, model: Model, ledger_file: Optional[pathlib.Path] = None):
+        self.model = model
+        self.ledger_file = ledger_file or Daikin.key_file.with_name(
+            "daikin_planner.json"
+        )
+
+    def _ledger(self, f, now: float) -> dict:
+        today = datetime.date.fromtimestamp(now).isoformat()
+        ledger = read_json(f, None) or {}
+        if ledger.get("day") != today:
+            ledger.update(day=today, patches=0)
+        return ledger
+
+    def patches_left(self, now: Optional[float] = None) -> int:
+        """How many more changes can be made today"""
+        with locked_file(self.ledger_file, shared=True) as f:
+            ledger = self._ledger(f, now or time.time())
+        return max(0, self.max_patches - ledger["patches"])
+
+    def _boost_due(self, now: float, hw: Optional[float]) -> bool:
+        if hw is None or math.isnan(hw) or hw >= self.hw_min:
+            return False
+        with locked_file(self.ledger_file, shared=True) as f:
+            ledger = self._ledger(f, now)
+        return now - ledger.get("boost", 0) > self.boost_window
+
+    def plan(
+        self,
+        now: float,
+        tariff: Sequence[Tuple[float, float]],
+        room: float,
+        target: float,
+        offset: float,
+        hw: Optional[float] = None,
+        outdoor: Optional[float] = None,
+        forecast: Optional[Sequence[float]] = None,
+        hours: float = 24,
+    ) -> Plan:
+        """Plan the next hours, starting from the current state.
+
+        forecast is the outdoor temperature for each slot (the last one
+        is used for the rest, if it's short) - without it, it's taken to
+        stay at outdoor. The whole plan has to fit within the changes
+        left for today, which is cautious if it goes past midnight, but
+        tomorrow's re-planning gets a fresh allowance.
+        """
+        n = int(hours * 3600 // SLOT)
+        times = np.maximum(now, (now // SLOT + np.arange(n)) * SLOT)
+        price = prices(tariff, times)
+        if forecast is not None and len(forecast):
+            temps = np.asarray(forecast, float)[:n]
+            temps = np.concatenate([temps, np.full(n - len(temps), temps[-1])])
+        else:
+            temps = np.full(n, 10.0 if outdoor is None else outdoor)
+
+        boost = np.zeros(n, bool)
+        budget = self.patches_left(now)
+        if self._boost_due(now, hw) and budget:
+            window = max(1, int(self.boost_window // SLOT))
+            boost[np.argmin(price[:window])] = True
+            budget -= 1
+
+        m = self.model
+        levels = np.array(self.offsets, float)
+        grid = np.arange(-self.span, self.span + self.step / 2, self.step)
+        G, L, K = len(grid), len(levels), budget + 1
+        dt = SLOT / 3600
+
+        # costs for each slot and offset, and for each room temperature
+        energy = price[:, None] * m.power(temps[:, None], levels[None, :]) * dt / 1000
+        discomfort = (
+            self.comfort * dt * np.clip(abs(grid) - self.comfort_band, 0, None) ** 2
+        )
+
+        # where each room temperature goes with each offset, as a position on
+        # the grid to interpolate at
+        pos = np.clip(
+            (m.step(grid[:, None], levels, dt) - grid[0]) / self.step, 0, G - 1
+        )
+        lo = np.minimum(pos.astype(int), G - 2)
+        w = (pos - lo)[:, :, None]
+        cols = np.arange(L)
+
+        # heat left in the house at the end is worth what it would cost
+        # to put in: a degree of offset for a slot buys gain * dt degrees
+        per_degree = m.per_offset * dt / 1000 / (m.gain * dt)
+        terminal = -grid * per_degree * price.mean()
+        V = np.broadcast_to(terminal[:, None, None], (G, L, K)).copy()
+
+        # V[d, l, k] is the least cost from the start of a slot onwards, with
+        # the room at grid[d], offset l set, and k changes made so far
+        values = [V]
+        for t in range(n - 1, -1, -1):
+            # choosing offset l: the cost, then wherever that leads to,
+            # indexed by the number of changes made after it
+            Q = (1 - w) * V[lo, cols] + w * V[lo + 1, cols]
+            Q += energy[t][None, :, None] + discomfort[:, None, None]
+            # changing it uses one up - none left means it can't be done
+            changed = np.concatenate([Q[:, :, 1:], np.full((G, L, 1), np.inf)], axis=2)
+            best = changed.min(axis=1)
+            second = np.partition(changed, 1, axis=1)[:, 1]
+            is_best = changed.argmin(axis=1)[:, None, :] == cols[None, :, None]
+            other = np.where(is_best, second[:, None, :], best[:, None, :])
+            V = np.minimum(Q, other)
+            values.append(V)
+        values.reverse()
+
+        # then forwards from where we actually are
+        dev = room - target
+        chosen = np.zeros(n)
+        predicted = [dev]
+        current, used, cost = offset, 0, 0.0
+        for t in range(n):
+            V = values[t + 1]
+            nxt = m.step(dev, levels, dt)
+            p = np.clip((nxt - grid[0]) / self.step, 0, G - 1)
+            i = np.minimum(p.astype(int), G - 2)
+            k = np.minimum(used + (levels != current), K - 1)
+            future = (1 - (p - i)) * V[i, cols, k] + (p - i) * V[i + 1, cols, k]
+            # (k is clipped so the indexing works - the ones over are no good)
+            future[used + (levels != current) >= K] = np.inf
+            l = int(np.argmin(energy[t] + future))
+            used = int(k[l])
+            current = chosen[t] = levels[l]
+            cost += energy[t, l]
+            dev = nxt[l]
+            predicted.append(dev)
+        cost += self.boost_kwh * price[boost].sum()
+        return Plan(times, chosen, boost, np.array(predicted), cost, offset)
+
+    def apply(self, plan: Plan, target) -> int:
+        """Make the changes the plan says are due now, through target -
+        a Daikin, or a PatchQueue. Returns the number made."""
+        made = 0
+        now = time.time()
+        with locked_file(self.ledger_file) as f:
+            ledger = self._ledger(f, now)
+            if plan.offsets[0] != plan.current and ledger["patches"] < self.max_patches:
+                # a PatchQueue says False if it's already set to that
+                if (
+                    target.set_temperature_control(
+                        "leavingWaterOffset", int(plan.offsets[0])
+                    )
+                    is not False
+                ):
+                    _logger.info("leaving water offset -> %d", plan.offsets[0])
+                    made += 1
+            if plan.boost[0] and ledger["patches"] + made < self.max_patches:
+                if target.set_powerful_mode(True) is not False:
+                    _logger.info("hot water boost")
+                    ledger["boost"] = now
+                    made += 1
+            ledger["patches"] += made
+            write_json(f, ledger)
+        return made
+
+
+def main():
+    logging.basicConfig(format="%(message)s", level=logging.INFO)
+    args = sys.argv[1:]
+    apply = "--apply" in args
+    args = [a for a in args if a != "--apply"]
+    if args:
+        with open(args[0]) as f:
+            tariff = json.load(f)  # [[hour, price], ...]
+    else:
+        tariff = EXAMPLE_TARIFF
+
+    now = time.time()
+    samples = np.frombuffer(
+        Store().read_bytes(now - 14 * 86400, now), dtype=NUMPY_DTYPE
+    )
+    if not len(samples):
+        print("no samples in the store - run one of the monitors first")
+        return
+    model = Model.fit(samples)
+    print(model)
+
+    # the latest from the Daikin, rather than a power-only one
+    daikin = samples[~np.isnan(samples["room"]) & ~np.isnan(samples["target"])]
+    if not len(daikin):
+        print("none of the samples has got the room temperature")
+        return
+    latest = daikin[-1]
+    planner = Planner(model)
+    start = time.perf_counter()
+    plan = planner.plan(
+        now,
+        tariff,
+        room=float(latest["room"]),
+        target=float(latest["target"]),
+        offset=0.0 if np.isnan(latest["offset"]) else float(latest["offset"]),
+        hw=float(latest["hw"]),
+        outdoor=float(latest["outdoor"]),
+    )
+    print(f"planned in {1000 * (time.perf_counter() - start):.0f}ms")
+    print(plan)
+
+    if apply:
+        patches = PatchQueue(Daikin())
+        planner.apply(plan, patches)
+        patches.flush()
+
+
+if __name__ == "__main__":
+    main()
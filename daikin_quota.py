@@ -0,0 +1,163 @@
+"""Keep track of the Daikin API rate limit, shared between processes.
+
+The API allows 200 requests per day (and 20 per minute). All the
+scripts share the same quota, so each of them keeping its own count
+isn't much use. Instead there is a little ledger file, next to the
+key file, which is used as a token bucket: it fills at 200 tokens per
+day, and each request takes one token out. Everything is done with
+the file locked, so several processes can safely draw from it.
+
+The server tells us how many requests are left in the response headers,
+so whenever we see those the ledger is brought back into line. That
+takes care of any requests we don't know about (eg from the phone app).
+If they say the day's allowance has all gone, nothing more is tried until
+it's reset (at midnight UTC), or for as long as Retry-After says - and then
+the bucket is filled right up again, as the server's allowance will be.
+
+Some of the budget is held back for writes, so that a monitor polling
+too often can't use up everything and leave us unable to change the
+settings.
+"""
+
+import logging
+import math
+import pathlib
+import time
+
+from typing import Optional
+
+from daikin_lock import locked_file, read_json, write_json
+
+_logger = logging.getLogger(__name__)
+
+
+class QuotaExceeded(Exception):
+    """Raised when a request can't be made without going over the limit.
+
+    wait is the number of seconds until it ought to be possible.
+    """
+
+    def __init__(self, wait: float):
+        super().__init__(f"api quota exhausted - try again in {wait:.0f} seconds")
+        self.wait = wait
+
+
+class Quota:
+    """A token-bucket ledger stored in a (locked) json file."""
+
+    # configuration
+    daily_limit = 200  # what the api allows
+    write_reserve = 30  # tokens that reads are not allowed to use
+    max_wait = 60  # how long acquire() will sleep rather than raise
+
+    def __init__(self, ledger_file: pathlib.Path):
+        self.ledger_file = ledger_file
+        self.rate = self.daily_limit / 86400  # tokens per second
+
+    def _refill(self, state: dict, now: float) -> dict:
+        """Top up the bucket according to the time since it was last updated"""
+        if not state:
+            # a new ledger - assume a full day's allowance
+            return {"tokens": float(self.daily_limit), "stamp": now, "blocked_until": 0}
+        elapsed = max(0, now - state["stamp"])
+        state["tokens"] = min(self.daily_limit, state["tokens"] + elapsed * self.rate)
+        state["stamp"] = now
+        if now >= state.get("reset_at", math.inf):
+            # the server has given us a whole new day's allowance
+            state["tokens"] = float(self.daily_limit)
+            del state["reset_at"]
+        return state
+
+    def _wait_needed(self, state: dict, now: float, write: bool) -> float:
+        """How long until a request could be made - 0 if it can be made now"""
+        floor = 1 if write else 1 + self.write_reserve
+        wait = max(0.0, floor - state["tokens"]) / self.rate
+        return max(wait, state.get("blocked_until", 0) - now)
+
+    def acquire(self, write: bool = False, max_wait: float = None) -> float:
+        """Take a token out of the bucket for a request.
+
+        If there isn't one available, sleep for up to max_wait seconds
+        until there is, or raise QuotaExceeded if that's not long enough.
+        Returns the number of tokens left.
+        """
+
+        if max_wait is None:
+            max_wait = self.max_wait
+
+        while True:
+            with locked_file(self.ledger_file) as f:
+                now = time.time()
+                state = self._refill(read_json(f, {}), now)
+                wait = self._wait_needed(state, now, write)
+                if wait <= 0:
+                    state["tokens"] -= 1
+                    write_json(f, state)
+                    return state["tokens"]
+                write_json(f, state)
+
+            # don't hold the lock while we're sleeping
+            if wait > max_wait:
+                raise QuotaExceeded(wait)
+            _logger.info("deferring request for %.0f seconds to stay within quota", wait)
+            max_wait -= wait
+            time.sleep(wait)
+
+    def update(self, status: int, headers) -> Optional[float]:
+        """Bring the ledger into line with the rate-limit headers from a response.
+
+        headers should be case-insensitive (as the requests ones are).
+        Returns the number of tokens left, or None if there was nothing to update.
+        """
+
+        remaining_day = headers.get("X-RateLimit-Remaining-day")
+        remaining_minute = headers.get("X-RateLimit-Remaining-minute")
+        retry_after = headers.get("Retry-After")
+
+        if remaining_day is None and remaining_minute is None and status != 429:
+            return None
+
+        with locked_file(self.ledger_file) as f:
+            now = time.time()
+            state = self._refill(read_json(f, {}), now)
+
+            if remaining_day is not None:
+                # the server knows best
+                state["tokens"] = float(remaining_day)
+                if state["tokens"] > 0:
+                    state.pop("reset_at", None)
+
+            try:
+                retry = int(retry_after)
+            except (TypeError, ValueError):
+                retry = None
+
+            blocked = 0
+            if remaining_minute is not None and int(remaining_minute) <= 0:
+                blocked = 60
+            if remaining_day is not None and float(remaining_day) <= 0:
+                # the refill would soon start letting requests through again,
+                # but there's no point until the day's allowance is reset
+                _logger.warning("daily api quota used up")
+                reset = retry or self._until_reset(now)
+                state["reset_at"] = now + reset
+                blocked = max(blocked, reset)
+            if status == 429:
+                _logger.warning("rate limited by server (retry-after %s)", retry_after)
+                blocked = max(blocked, retry or 60)
+            if blocked:
+                state["blocked_until"] = max(state.get("blocked_until", 0), now + blocked)
+
+            write_json(f, state)
+            return state["tokens"]
+
+    @staticmethod
+    def _until_reset(now: float) -> float:
+        """Seconds until the daily limit is reset (at midnight UTC)"""
+        return 86400 - now % 86400
+
+    def remaining(self) -> float:
+        """The number of tokens currently in the bucket"""
+        with locked_file(self.ledger_file, shared=True) as f:
+            state = self._refill(read_json(f, {}), time.time())
+        return state["tokens"]
@@ -0,0 +1,158 @@
+"""Decide how often to poll the api.
+
+The monitor scripts used to just sleep for 10 minutes between polls,
+whether anything was happening or not. A PollScheduler instead picks
+the interval each time round from
+  - how much of the daily quota is left (see daikin_quota.py): there's
+    no point polling faster than we can afford, but if there's spare
+    we can use it
+  - how fast the values have been changing recently: poll more often
+    during a defrost or hot-water cycle, less often when it's idle
+  - a time-of-day profile: eg poll less often overnight.
+
+The interval is one of a few that divide an hour exactly, and polls
+are lined up with the clock (eg on the 10 minutes), so they don't drift
+by the time each request takes.
+"""
+
+import logging
+import math
+import time
+
+from typing import Callable, Dict, List, Optional, Tuple
+
+import requests
+
+from daikin_fields import SENSORS
+from daikin_quota import Quota, QuotaExceeded
+
+_logger = logging.getLogger(__name__)
+
+
+class PollScheduler:
+    # the possible intervals, in seconds
+    intervals = (300, 600, 900, 1200, 1800, 3600)
+
+    # how much each value has to change (per 10 minutes) to count as "busy"
+    thresholds = {
+        "outdoor": 2,
+        "room": 0.5,
+        "target": 0.5,
+        "hw": 2,
+        "lwt": 3,
+        "power": 300,
+    }
+
+    # (hour, factor) - from each hour onwards, the interval is scaled by factor
+    default_profile = [(0, 2.0), (6, 1.0), (23, 2.0)]
+
+    # how far ahead to spread any spare quota
+    horizon = 6 * 3600
+
+    def __init__(
+        self,
+        quota: Quota,
+        profile: Optional[List[Tuple[int, float]]] = None,
+        min_interval: float = 300,
+        max_interval: float = 3600,
+    ):
+        self.quota = quota
+        self.profile = sorted(profile or self.default_profile)
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        # smoothed: 0 = idle, 1 = changing about as much as the thresholds
+        self.activity = 0.0
+        self._last: Optional[Tuple[float, Dict[str, float]]] = None
+
+    def observe(self, t: float, values: Dict[str, Optional[float]]) -> None:
+        """Tell the scheduler about a new sample, so it can see how busy things are"""
+        values = {
+            k: v for k, v in values.items() if v is not None and k in self.thresholds
+        }
+        if self._last is not None:
+            t0, old = self._last
+            per_10min = 600 / max(60.0, t - t0)
+            change = max(
+                (
+                    abs(values[k] - old[k]) * per_10min / self.thresholds[k]
+                    for k in values
+                    if k in old
+                ),
+                default=0.0,
+            )
+            self.activity = 0.5 * self.activity + 0.5 * change
+        self._last = (t, values)
+
+    def poll(
+        self,
+        fetch: Callable[..., Optional[list]],
+        device: Optional[str] = None,
+        deadline: Optional[float] = None,
+        name: Optional[str] = None,
+    ) -> Tuple[bool, Optional[list]]:
+        """Make one poll, with fetch(deadline=...) - eg Daikin.poll - and
+        observe() the sensor values from it.
+
+        It's given until the next poll is due (or deadline), so a slow cloud
+        never makes the next one late. If it fails, that's logged, and it's
+        (False, None) - just skip the sample and try again next time.
+        Otherwise it's (True, whatever fetch returned). If that's None
+        (nothing has changed), the values from last time are observed again.
+        name, if given, goes at the start of the warning.
+        """
+        try:
+            gw = fetch(deadline=deadline or self.next_time())
+        except (QuotaExceeded, requests.RequestException) as e:
+            _logger.warning("%s%s", f"{name}: " if name else "", e)
+            return False, None
+        now = time.time()
+        if gw is not None:
+            self.observe(now, SENSORS.extract(gw, device).as_dict())
+        elif self._last is not None:
+            self.observe(now, self._last[1])
+        return True, gw
+
+    def _profile_factor(self, now: float) -> float:
+        hour = time.localtime(now).tm_hour
+        factor = 1.0
+        for start, f in self.profile:
+            if hour >= start:
+                factor = f
+        return factor
+
+    def _affordable(self) -> float:
+        """The shortest interval the quota will stand at the moment"""
+        q = self.quota
+        tokens = q.remaining() - q.write_reserve - 1
+        if tokens < 0:
+            # overdrawn - wait until reads are possible again
+            return -tokens / q.rate
+        # what the refill pays for, less the share kept for writes,
+        # plus any spare spread over the horizon
+        sustainable = q.rate * (1 - q.write_reserve / q.daily_limit)
+        return 1 / (sustainable + tokens / self.horizon)
+
+    def next_interval(self, now: Optional[float] = None) -> float:
+        now = now or time.time()
+        base = 600 * self._profile_factor(now) / (1 + self.activity)
+        wanted = min(self.max_interval, max(self.min_interval, base))
+        wanted = max(wanted, self._affordable())
+        # round up to one of the clock-friendly intervals
+        for interval in self.intervals:
+            if interval >= wanted - 1:
+                return interval
+        return math.ceil(wanted / 3600) * 3600
+
+    def next_time(self, now: Optional[float] = None) -> float:
+        """When the next poll should be - on a multiple of the interval,
+        counting from local midnight"""
+        now = now or time.time()
+        interval = self.next_interval(now)
+        offset = time.localtime(now).tm_gmtoff
+        return (math.floor((now + offset) / interval) + 1) * interval - offset
+
+    def sleep(self) -> float:
+        """Sleep until the next poll is due, and return that time"""
+        when = self.next_time()
+        time.sleep(max(0.0, when - time.time()))
+        return when
@@ -0,0 +1,180 @@
+"""A compact store for the values sampled by the monitor scripts.
+
+The log files are fine for looking at, but to do anything with months of
+them means decompressing and parsing all the text. So the samples are
+also written here, as fixed-size binary records:
+
+    time (uint32, seconds since epoch)
+    outdoor, room, target, hw, lwt, offset, power (float32, NaN if missing)
+
+Records are appended to one segment file per month, named like 202410.seg,
+in time order. Each record is written with a single write() to a file
+opened for appending, so a crash can at worst leave a partial record at
+the end - readers ignore that, and the next writer trims it off.
+
+Several processes (eg both monitors) can append to the same segment, so
+each append is done with the file flock()ed, and checks the last record
+in the file rather than just the last one it wrote itself. If another
+process has just stored a later sample, this one is stored with that
+one's time instead (they're never more than a moment apart), so the
+file stays in order for the binary search.
+
+Reading uses mmap. The segment table (file name plus the first and last
+timestamps) picks out the segments covering a time range, then a binary
+search on the timestamps within each finds the records, so only a few
+pages get touched. The result can go straight into numpy:
+
+    np.frombuffer(store.read_bytes(start, end), dtype=NUMPY_DTYPE)
+"""
+
+import bisect
+import fcntl
+import math
+import mmap
+import os
+import pathlib
+import struct
+import time
+
+from collections import namedtuple
+from typing import Iterator, List, Optional
+
+FIELDS = ("outdoor", "room", "target", "hw", "lwt", "offset", "power")
+
+RECORD = struct.Struct("<I" + "f" * len(FIELDS))
+
+NUMPY_DTYPE = [("time", "<u4")] + [(f, "<f4") for f in FIELDS]
+
+Sample = namedtuple("Sample", ("time",) + FIELDS)
+
+
+class _Segment:
+    """A read-only view of one segment file"""
+
+    def __init__(self, path: pathlib.Path):
+        self.path = path
+        with path.open("rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            self.count = size // RECORD.size  # ignore any partial record
+            if self.count:
+                self.map = mmap.mmap(
+                    f.fileno(), self.count * RECORD.size, access=mmap.ACCESS_READ
+                )
+            else:
+                self.map = b""
+
+        # so that bisect can search the timestamps in place
+        self.times = _Times(self.map, self.count)
+
+    def first(self) -> int:
+        return self.times[0]
+
+    def last(self) -> int:
+        return self.times[self.count - 1]
+
+    def slice(self, start: float, end: float) -> memoryview:
+        """The records with start <= time < end"""
+        lo = bisect.bisect_left(self.times, start)
+        hi = bisect.bisect_left(self.times, end, lo)
+        return memoryview(self.map)[lo * RECORD.size : hi * RECORD.size]
+
+
+class _Times:
+    """Make the timestamps in a mapped segment look like a sequence"""
+
+    def __init__(self, buf, count: int):
+        self.buf = buf
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i: int) -> int:
+        return struct.unpack_from("<I", self.buf, i * RECORD.size)[0]
+
+
+class Store:
+    """A directory of monthly segment files."""
+
+    default_dir = pathlib.Path.home() / ".daikin_store"
+
+    def __init__(self, directory: Optional[pathlib.Path] = None, sync: bool = True):
+        """If sync is set, each append is fsync()ed to disk"""
+        self.dir = directory or self.default_dir
+        self.dir.mkdir(parents=True, exist_ok=True)
+        self.sync = sync
+        self._fd = None  # the segment we're currently appending to
+        self._fd_name = None
+        self._last = 0
+
+    def _segment_path(self, t: float) -> pathlib.Path:
+        return self.dir / (time.strftime("%Y%m", time.gmtime(t)) + ".seg")
+
+    def _open_for_append(self, path: pathlib.Path) -> None:
+        if self._fd is not None:
+            os.close(self._fd)
+        self._fd = os.open(path, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+        self._fd_name = path.name
+
+    def append(self, t: float, **values) -> None:
+        """Add a sample. Fields not given (or None) are stored as NaN.
+
+        Samples must be added in time order. If another process has stored
+        a later one in the meantime, this one is stored at that time instead.
+        """
+        path = self._segment_path(t)
+        if path.name != self._fd_name:
+            self._open_for_append(path)
+        t = int(t)
+        if t < self._last:
+            raise ValueError(f"sample at {t} is older than the last one stored")
+
+        nan = math.nan
+        fields = [nan if values.get(f) is None else values[f] for f in FIELDS]
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            # tidy up after a crash part way through writing a record
+            size = os.fstat(self._fd).st_size
+            if size % RECORD.size:
+                os.ftruncate(self._fd, size - size % RECORD.size)
+                size -= size % RECORD.size
+            # another process may have stored a later one meanwhile
+            if size:
+                last = RECORD.unpack(
+                    os.pread(self._fd, RECORD.size, size - RECORD.size)
+                )
+                stamp = max(t, last[0])
+            else:
+                stamp = t
+            os.write(self._fd, RECORD.pack(stamp, *fields))
+            if self.sync:
+                os.fsync(self._fd)
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        # (the order check is against the times we were given - another
+        # process getting in first isn't this one's mistake)
+        self._last = t
+
+    def close(self) -> None:
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+            self._fd_name = None
+
+    def segments(self) -> List[_Segment]:
+        """Open all the (non-empty) segments, in time order"""
+        segs = (_Segment(p) for p in sorted(self.dir.glob("*.seg")))
+        return [s for s in segs if s.count]
+
+    def read_bytes(self, start: float = 0, end: float = 2**32) -> bytes:
+        """The raw records with start <= time < end"""
+        return b"".join(
+            s.slice(start, end)
+            for s in self.segments()
+            if s.last() >= start and s.first() < end
+        )
+
+    def samples(self, start: float = 0, end: float = 2**32) -> Iterator[Sample]:
+        """Iterate over the samples with start <= time < end"""
+        for rec in RECORD.iter_unpack(self.read_bytes(start, end)):
+            yield Sample(*rec)
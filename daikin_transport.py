@@ -0,0 +1,163 @@
+"""The http side of things, for both the token requests and the api.
+
+Both go through one requests.Session, so the connections (and TLS
+sessions) to the two servers are kept open and reused, rather than the
+token refresh opening a new one each time.
+
+Retries are done here rather than by urllib3, because its Retry backs off
+blindly (with backoff_factor=5, a few failures could leave a call sleeping
+for minutes), and ignores Retry-After. Instead each call has a deadline,
+and it only retries, or waits, if that fits within it - otherwise whatever
+it's got is returned (or raised), so the caller can get on with things.
+A poll loop can pass the time of its next poll as the deadline, so a slow
+cloud never makes it late.
+
+Every attempt counts against the api quota, retries included, so the
+caller can pass a before hook which is called ahead of each one - Daikin
+uses that to take a token from the ledger, which raises QuotaExceeded
+rather than retrying into a limit that's already been hit.
+"""
+
+import email.utils
+import logging
+import time
+
+from typing import Callable, Optional
+
+import requests
+
+from requests.adapters import HTTPAdapter
+
+_logger = logging.getLogger(__name__)
+
+
+def retry_after(r: requests.Response) -> Optional[float]:
+    """How many seconds the server has asked us to wait, if it has"""
+    value = r.headers.get("Retry-After")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        # it's allowed to be an http date instead
+        return max(
+            0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time()
+        )
+    except (TypeError, ValueError):
+        return None
+
+
+class Transport:
+    # responses worth trying again
+    retry_statuses = (429, 500, 502, 503, 504)
+
+    # methods which are safe to repeat even if the request might have got
+    # there (refresh tokens only work once, and patches aren't idempotent)
+    idempotent = ("GET", "HEAD")
+
+    # the time allowed for each attempt, and for a whole call
+    timeout = 30
+    budget = 90
+
+    # backoff between attempts, when the server doesn't say
+    backoff = 1.0
+    max_backoff = 30.0
+
+    def __init__(self, pool_size: int = 4):
+        self.session = requests.Session()
+        self.session.headers.update({"Accept-Encoding": "gzip"})
+        # no retries at this level - see request()
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def warm_up(self, *urls: str) -> None:
+        """Open connections to the servers in advance, so the first real
+        request doesn't have to wait for the handshakes"""
+        for url in urls:
+            try:
+                self.session.head(url, timeout=5)
+            except requests.RequestException as e:
+                _logger.debug("warm up of %s failed: %s", url, e)
+
+    def request(
+        self,
+        method: str,
+        url: str,
+        deadline: Optional[float] = None,
+        on_response: Optional[Callable[[requests.Response, int, float], None]] = None,
+        before: Optional[Callable[[int], None]] = None,
+        **kwargs,
+    ) -> requests.Response:
+        """Make a request, retrying while there's time.
+
+        deadline is a time.time() by which it has to be done - default is
+        budget seconds from now. on_response, if given, is called with
+        (response, attempt, seconds) for every response received, including
+        the ones that get retried. before, if given, is called with the
+        attempt number before each attempt is made - if it raises, so does
+        this.
+
+        Returns the final response, whatever its status - it's up to the
+        caller to raise_for_status(). Raises requests.Timeout if the deadline
+        passes without one, or the last connection error.
+        """
+        deadline = deadline or time.time() + self.budget
+        attempt = 0
+        while True:
+            attempt += 1
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise requests.Timeout(f"{method} {url}: out of time")
+            if before:
+                before(attempt)
+            start = time.perf_counter()
+            try:
+                r = self.session.request(
+                    method, url, timeout=min(self.timeout, remaining), **kwargs
+                )
+            except requests.ConnectionError as e:
+                # if we never connected, the request can't have got there
+                if method not in self.idempotent and not isinstance(
+                    e, requests.ConnectTimeout
+                ):
+                    raise
+                wait = self._backoff(attempt)
+                if time.time() + wait >= deadline:
+                    raise
+                _logger.info(
+                    "%s %s failed (%s) - retrying in %.0fs", method, url, e, wait
+                )
+            except requests.Timeout:
+                if method not in self.idempotent:
+                    raise
+                wait = self._backoff(attempt)
+                if time.time() + wait >= deadline:
+                    raise
+                _logger.info("%s %s timed out - retrying in %.0fs", method, url, wait)
+            else:
+                if on_response:
+                    on_response(r, attempt, time.perf_counter() - start)
+                if r.status_code not in self.retry_statuses:
+                    return r
+                # servers only send 429 and 503 when they haven't done anything
+                if method not in self.idempotent and r.status_code not in (429, 503):
+                    return r
+                wait = retry_after(r)
+                if wait is None:
+                    wait = self._backoff(attempt)
+                if time.time() + wait >= deadline:
+                    return r
+                _logger.info(
+                    "%s %s gave %d - retrying in %.0fs",
+                    method,
+                    url,
+                    r.status_code,
+                    wait,
+                )
+            time.sleep(wait)
+
+    def _backoff(self, attempt: int) -> float:
+        return min(self.max_backoff, self.backoff * 2 ** (attempt - 1))
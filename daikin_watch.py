@@ -0,0 +1,148 @@
+"""Watch for changes to particular values, rather than polling for them.
+
+    for event in daikin.watch(["climateControlMainZone/sensoryData/value"]):
+        print(event.path, event.old, "->", event.new)
+
+The paths are like the FieldSpec ones (see daikin_fields.py) - the
+embeddedId of a management point, then the keys down from there - but a
+path can also be part of the way down, in which case anything under it is
+watched. An event is yielded each time one of the values changes, with
+the full path, the old and new values, and the time of the poll it was
+seen in. The first events for each watch are the current values, with
+old as None. (A value which disappears gives new as None.)
+
+However many watches there are on a Daikin, there's one Watcher doing
+the polling, in a thread of its own, as often as a PollScheduler says.
+It works out which values have changed once per poll, and each watch
+just picks out the ones it's interested in. When the last watch finishes
+(ie the generator is closed, or garbage collected), the thread stops.
+"""
+
+import logging
+import queue
+import threading
+import time
+
+from collections import namedtuple
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+from daikin_archive import flatten
+from daikin_schedule import PollScheduler
+
+_logger = logging.getLogger(__name__)
+
+ChangeEvent = namedtuple("ChangeEvent", "path old new time")
+
+
+def changes(old: Dict[str, Any], new: Dict[str, Any]) -> List[tuple]:
+    """(path, old, new) for each value which differs between two flattened
+    gateway-devices results"""
+    changed = [(p, old.get(p), v) for p, v in new.items() if old.get(p) != v]
+    changed.extend((p, v, None) for p, v in old.items() if p not in new)
+    return changed
+
+
+class Subscription:
+    """One watch - the paths it wants, and a queue of events for it"""
+
+    def __init__(self, paths: Iterable[str], device: Optional[str]):
+        self.paths = tuple(p.strip("/") for p in paths)
+        self.device = device
+        self.queue: "queue.Queue[ChangeEvent]" = queue.Queue()
+
+    def wants(self, path: str) -> bool:
+        return any(path == p or path.startswith(p + "/") for p in self.paths)
+
+    def offer(self, device: str, changed: List[tuple], t: float) -> None:
+        """Queue the changes which are for this watch. changed is a list of
+        (full path, old, new), the full paths starting with the device id."""
+        prefix = (self.device or device) + "/"
+        for path, old, new in changed:
+            if path.startswith(prefix) and self.wants(path[len(prefix) :]):
+                self.queue.put(ChangeEvent(path[len(prefix) :], old, new, t))
+
+
+class Watcher:
+    """Polls one Daikin on behalf of all the watches on it"""
+
+    def __init__(self, daikin, scheduler: Optional[PollScheduler] = None):
+        self.daikin = daikin
+        self.scheduler = scheduler or PollScheduler(daikin.quota)
+        self.subscriptions: List[Subscription] = []
+        self.state: Dict[str, Any] = {}  # flattened, as of the last poll
+        self.stamp = 0.0  # when that was
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+
+    def watch(
+        self, paths: Iterable[str], device: Optional[str] = None
+    ) -> Iterator[ChangeEvent]:
+        """Yield the changes to the values under paths, for ever"""
+        sub = self.subscribe(paths, device)
+        try:
+            while True:
+                yield sub.queue.get()
+        finally:
+            self.unsubscribe(sub)
+
+    def subscribe(
+        self, paths: Iterable[str], device: Optional[str] = None
+    ) -> Subscription:
+        sub = Subscription(paths, device)
+        with self.lock:
+            if self.state:
+                # it hasn't seen anything yet, so it all counts as new
+                sub.offer(
+                    self.daikin.device,
+                    [(p, None, v) for p, v in self.state.items()],
+                    self.stamp,
+                )
+            self.subscriptions.append(sub)
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self._run, name="daikin-watch", daemon=True
+                )
+                self.thread.start()
+        return sub
+
+    def unsubscribe(self, sub: Subscription) -> None:
+        with self.lock:
+            self.subscriptions.remove(sub)
+            if not self.subscriptions:
+                self.wake.set()  # so the thread notices, and stops
+
+    def _run(self) -> None:
+        while True:
+            try:
+                self.poll()
+            except Exception:
+                _logger.exception("watch poll failed")
+            when = self.scheduler.next_time()
+            while True:
+                self.wake.wait(max(0.0, when - time.time()))
+                with self.lock:
+                    if not self.subscriptions:
+                        self.thread = None
+                        self.wake.clear()
+                        return
+                    if not self.wake.is_set():
+                        break  # time for the next poll
+                    # the last watch finished, but there's a new one now
+                    self.wake.clear()
+
+    def poll(self) -> None:
+        """Fetch the gateway devices, and tell the watches about any changes"""
+        ok, gw = self.scheduler.poll(self.daikin.gateway_devices, self.daikin.device)
+        if not ok:
+            return
+        now = time.time()
+        self.daikin._make_index(gw, now)
+
+        state = flatten(gw)
+        with self.lock:
+            changed = changes(self.state, state)
+            self.state, self.stamp = state, now
+            if changed:
+                for sub in self.subscriptions:
+                    sub.offer(self.daikin.device, changed, now)